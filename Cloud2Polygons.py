@@ -24,7 +24,10 @@
 # This module contains all the functions that, given a point cloud, allow to
 # obtain a set of MultiPolygons at specified z coordinates.
 ###############################################################################
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from scipy.spatial import cKDTree
+from numba import njit
 import shapely
 import shapely.geometry as sg
 import ezdxf
@@ -65,26 +68,181 @@ def make_slices(zcoords, pcl, thick, npts):
     
     Given zcoords, pcl and the slice thickness, returns the dictionary
     "slices", defined as key=zcoord_i & value=slice_i, 
-    where slice_i=np.array([[x1, y1, z1], [x2, y2, z2],..., [xn, yn, zn]]).
+    where slice_i=np.array([[x1, y1, z1], [x2, y2, z2],..., [xn, yn, zn]]) (float32).
+    The points are selected on the z coordinates of pcl, before any conversion.
     
-    npts and netpcl are needed only for 3D visualization purposes, as well as
+    It also returns netmask, the boolean mask of the points of pcl that are not in any slice,
+    packed into bits by np.packbits (unpack it with count=npts).
+    
+    npts and netmask are needed only for 3D visualization purposes, as well as
     for the z coordinates in  slice_i
     """
     slices = {}  # Dictionary to be filled with key=zcoord_i, value=slice_i
     invmask = np.ones(npts, dtype=bool)  # For 3D visualization purposes
     
+    # Every slice is a contiguous range of the points sorted by z, found by binary search.
+    # pcl itself is not reordered: the indices of each range are sorted back to keep
+    # the original order of the points, on which the centroids of the slice depend
+    zorder = np.argsort(pcl[:, 2], kind='stable')
+    zsorted = pcl[zorder, 2]
     for z in zcoords:
-        mask = np.logical_and(pcl[:, 2] >= (z - thick/2), pcl[:, 2] <= (z + thick/2))
-        slices[z] = pcl[mask, :]  # Fill the dict with key=z and value=slice_i
-        invmask *= np.invert(mask)  # For 3D visualization purposes
-    netpcl = pcl[invmask, :]  # Net point cloud for 3D visualization purposes
-    return slices, netpcl
+        lo = np.searchsorted(zsorted, z - thick/2, side='left')
+        hi = np.searchsorted(zsorted, z + thick/2, side='right')
+        sliceidx = np.sort(zorder[lo: hi])
+        # Fill the dict with key=z and value=slice_i, stored as a contiguous float32 array
+        slices[z] = np.ascontiguousarray(pcl[sliceidx, :], dtype=np.float32)
+        invmask[sliceidx] = False  # For 3D visualization purposes
+    netmask = np.packbits(invmask)  # 1 bit per point instead of a copy of the net point cloud
+    return slices, netmask
+
+
+
+
+
+@njit(cache=True, fastmath=True)
+def _greedy_centroids(xy, nbrptr, nbridx, tolpt):
+    """
+    xy    : 2-columns np array of the points of a slice
+    nbrptr: 1-d np array, the near points of xy[i] are nbridx[nbrptr[i]: nbrptr[i + 1]]
+    nbridx: 1-d np array of the indices of the near points of every point (see nbrptr)
+    tolpt : Minimum number of points needed to calculate the centroid
+    
+    Compiled kernel of find_centroids(). Points are not removed from xy, they are
+    flagged as used in the boolean array alive. Returns the 2-columns np array
+    of the centroids, empty if the first centroid could not be found.
+    """
+    npts = xy.shape[0]
+    alive = np.ones(npts, dtype=np.bool_)   # False for the points already removed from the slice
+    nalive = npts                           # Number of points still in the slice
+    ctrds = np.empty((npts, 2))             # Centroids, filled up to nctrds
+    nctrds = 0
+
+    ##### PROCEDURE FOR THE FIRST CENTROID #####
+    for stidx in range(npts):
+        alive[stidx] = False  # Removes the starting point from the slice
+        nalive -= 1
+        nnear = 0
+        for k in range(nbrptr[stidx], nbrptr[stidx + 1]):
+            if alive[nbridx[k]]:
+                nnear += 1
+        if nnear < tolpt:
+            continue
+        sumx = 0.0
+        sumy = 0.0
+        for k in range(nbrptr[stidx], nbrptr[stidx + 1]):
+            if alive[nbridx[k]]:
+                sumx += xy[nbridx[k], 0]
+                sumy += xy[nbridx[k], 1]
+                alive[nbridx[k]] = False  # Removes the used points from the slice
+        nalive -= nnear
+        ctrds[0, 0] = sumx / nnear
+        ctrds[0, 1] = sumy / nnear
+        nctrds = 1
+        break
+    if nctrds == 0:
+        return ctrds[: 0]
+
+    ##### PROCEDURE FOR THE FOLLOWING CENTROIDS #####
+    cands = np.arange(npts)  # Indices of the points that could still be alive, compacted from time to time
+    ncands = npts
+    while nalive > 0:
+        if 2 * nalive < ncands:
+            j = 0
+            for i in range(ncands):
+                if alive[cands[i]]:
+                    cands[j] = cands[i]
+                    j += 1
+            ncands = j
+        # The new starting point is the nearest to the last found centroid
+        # The search starts from the first alive candidate, not from an infinite
+        # distance: fastmath lets the compiler assume there are no infinities
+        nearestidx = -1
+        nearestd2 = 0.0
+        for i in range(ncands):
+            if alive[cands[i]]:
+                dx = xy[cands[i], 0] - ctrds[nctrds - 1, 0]
+                dy = xy[cands[i], 1] - ctrds[nctrds - 1, 1]
+                if nearestidx == -1 or dx * dx + dy * dy < nearestd2:
+                    nearestd2 = dx * dx + dy * dy
+                    nearestidx = cands[i]
+        alive[nearestidx] = False  # Removes the nearest point (new starting point) from the slice
+        nalive -= 1
+        nnear = 0
+        for k in range(nbrptr[nearestidx], nbrptr[nearestidx + 1]):
+            if alive[nbridx[k]]:
+                nnear += 1
+        if nnear < tolpt:
+            continue
+        sumx = 0.0
+        sumy = 0.0
+        for k in range(nbrptr[nearestidx], nbrptr[nearestidx + 1]):
+            if alive[nbridx[k]]:
+                sumx += xy[nbridx[k], 0]
+                sumy += xy[nbridx[k], 1]
+                alive[nbridx[k]] = False
+        nalive -= nnear
+        ctrds[nctrds, 0] = sumx / nnear
+        ctrds[nctrds, 1] = sumy / nnear
+        nctrds += 1
+    return ctrds[: nctrds]
+
+
+
+
+
+def _slice_centroids(args):
+    """
+    args: tuple (z, zslice, checkidx, minwthick, tolsl, tolpt, tol, tolincr), where zslice
+          is the slice at z, checkidx are the indices of the points used to derive newtol
+          and the other items are the same as in find_centroids()
+    
+    Returns the centroids of a single slice, or None if they cannot be derived.
+    It is defined at module level to be executed by the worker processes of find_centroids().
+    """
+    z, zslice, checkidx, minwthick, tolsl, tolpt, tol, tolincr = args
+    empsl = np.ascontiguousarray(zslice[:, [0, 1]])  # Slice (2 columns np array) to be emptied
+    
+    ##### CALIBRATION OF "tol" FOR EVERY SLICE #####
+    # Extract a random subset from the whole slice -> slcheckpts
+    slcheckpts = empsl[checkidx]
+    # The kd-tree of the slice is built once, for the calibration and for the centroids
+    tree = cKDTree(empsl)
+    newtol = tol  # Only newtol will be used in the following. It could remain equal to tol or be increased
+    while True:
+        # For every point p in slcheckpts, count how many points are at most newtol away from it
+        sumnearpts = tree.query_ball_point(slcheckpts, newtol, return_length=True).sum()
+        if newtol >= minwthick / tolincr:
+            print('\nTolerance adopted for slice ', "%.3f" % z, ':', "%.5f" % newtol)
+            break
+        elif sumnearpts < (3.5 * tolpt * slcheckpts.shape[0]):  # Values smaller than 3tolpt don't work really well. Default = 3.5, grezzo = 15
+            newtol *= tolincr
+            continue
+        else:
+            print('\nTolerance adopted for slice ', "%.3f" % z, ':', "%.5f" % newtol)
+            break
+
+    ##### CENTROIDS #####
+    if empsl.shape[0] < tolsl:
+        print("Slice:   ", "%.3f" % z, "            is empty")
+        return None
+    # Near points of every point, flattened for the compiled kernel
+    nearpts = tree.query_ball_point(empsl, newtol)
+    nbrptr = np.zeros(empsl.shape[0] + 1, dtype=np.int64)
+    nbrptr[1:] = np.cumsum([len(near) for near in nearpts])
+    nbridx = np.concatenate(nearpts).astype(np.int64)
+    zctrds = _greedy_centroids(empsl, nbrptr, nbridx, tolpt)
+    if zctrds.shape[0] == 0:
+        print("Slice:   ", "%.3f" % z, "        Slice n of points:  ", zslice.shape[0], "     discarded because n of points to generate the centroids is not sufficient")
+        return None
+    zctrds = np.hstack((zctrds, np.full((zctrds.shape[0], 1), z)))
+    print('Slice:   ', "%.3f" % z, '        Slice n of points:  ', zslice.shape[0], "     Derived centroids:  ", zctrds.shape[0])
+    return zctrds
 
 
 
 
 
-def find_centroids(minwthick, zcoords, slices, tolsl=10, tolpt=2, tol=0.01, checkpts=0.1, tolincr=1.35):
+def find_centroids(minwthick, zcoords, slices, tolsl=10, tolpt=2, tol=0.01, checkpts=0.1, tolincr=1.35, seed=None):
     """
     minwthick: Minimum wall thickness
     zcoords  : 1-d np array of z coords as that returned by func "make_zcoords()"
@@ -95,75 +253,24 @@ def find_centroids(minwthick, zcoords, slices, tolsl=10, tolpt=2, tol=0.01, chec
     tol      : Radius of the circle which defines the area where to look for near points, default=0.01 if [m]
     checkpts : Fraction of the slice's points used to derive newtol, default=0.1
     tolincr  : Increment factor used to find the appropriate tolerance, default=1.35
+    seed     : Seed of the random generator used to extract the subsets of points, default=None
     
     Given the arguments, returns the dictionary ctrds defined as key=zcoord_i &
     value=centroids_i, where centroids_i=np.array([[x1, y1, z1], [x2, y2, z2]....]).
     Z coordinates are stored in centroids_i only for 3D visualization purposes.
+    Slices are processed in parallel by a pool of worker processes.
     """
     ctrds = {}  # Dict to be filled: key=zcoord_i, value=centroids derived from slice_i
+    rng = np.random.default_rng(seed)
+    tasks = []
     for z in zcoords:
-        
-        ##### CALIBRATION OF "tol" FOR EVERY SLICE #####
-        # Extract a random subset from the whole slice -> slcheckpts
-        slcheckpts = slices[z][np.random.choice(slices[z].shape[0], size=round(slices[z].shape[0] * checkpts), replace=False)]
-        newtol = tol  # Only newtol will be used in the following. It could remain equal to tol or be increased
-        while True:
-            sumnearpts = 0
-            for checkpt in slcheckpts:
-                # For every point p in slcheckpts, count how many points are at most newtol away from it
-                dists = np.sqrt(np.square(slices[z][:, 0] - checkpt[0]) + np.square(slices[z][:, 1] - checkpt[1]))
-                nearpts = slices[z][dists <= newtol]
-                sumnearpts += nearpts.shape[0]
-            if newtol >= minwthick / tolincr:
-                print('\nTolerance adopted for slice ', "%.3f" % z, ':', "%.5f" % newtol)
-                break
-            elif sumnearpts < (3.5 * tolpt * slcheckpts.shape[0]):  # Values smaller than 3tolpt don't work really well. Default = 3.5, grezzo = 15
-                newtol *= tolincr
-                continue
-            else:
-                print('\nTolerance adopted for slice ', "%.3f" % z, ':', "%.5f" % newtol)
-                break
-
-        ##### PROCEDURE FOR THE FIRST CENTROID #####
-        empsl = slices[z][:, [0, 1]]        # Slice (2 columns np array) to be emptied
-        if empsl.shape[0] < tolsl:
-            ctrds[z] = None
-            print("Slice:   ", "%.3f" % z, "            is empty")
-            continue
-        try:
-            while True:
-                stpnt = empsl[0]                    # Starting point
-                empsl = np.delete(empsl, 0, 0)      # Removes the starting point from empsl
-                dists = np.sqrt(np.square(empsl[:, 0] - stpnt[0]) + np.square(empsl[:, 1] - stpnt[1]))
-                nearpts = empsl[dists <= newtol]
-                if nearpts.shape[0] < tolpt:
-                    continue
-                ctrds[z] = np.array([[nearpts[:, 0].mean(), nearpts[:, 1].mean(), z]])
-                empsl = empsl[dists > newtol]         # Removes the used points from empsl
-                ncs = 1                               # Number of found centroids
-                break
-        except IndexError:
-            print("Slice:   ", "%.3f" % z, "        Slice n of points:  ", slices[z].shape[0], "     discarded because n of points to generate the centroids is not sufficient")
-            ctrds[z] = None
-            continue
-        
-        ##### PROCEDURE FOR THE FOLLOWING CENTROIDS #####
-        while True:
-            nearestidx = np.argmin(np.sqrt(np.square(empsl[:, 0] - ctrds[z][ncs-1, 0]) + np.square(empsl[:, 1] - ctrds[z][ncs-1, 1])))
-            nearest = empsl[nearestidx]              # The new starting point (nearest to the last found centroid)
-            empsl = np.delete(empsl, nearestidx, 0)  # Removes the nearest point (new starting point) from empsl
-            dists = np.sqrt(np.square(empsl[:, 0] - nearest[0]) + np.square(empsl[:, 1] - nearest[1]))
-            nearpts = empsl[dists <= newtol]
-            if nearpts.shape[0] < tolpt and empsl.shape[0] > 0:
-                continue
-            elif empsl.shape[0] < 1:
-                break
-            ctrds[z] = np.vstack((ctrds[z], np.array([nearpts[:, 0].mean(), nearpts[:, 1].mean(), z])))
-            empsl = empsl[dists > newtol]
-            ncs += 1
-            if empsl.shape[0] < 1:
-                break
-        print('Slice:   ', "%.3f" % z, '        Slice n of points:  ', slices[z].shape[0], "     Derived centroids:  ", ctrds[z].shape[0])
+        # The random subsets are drawn here, so they do not depend on the worker processes
+        npts = slices[z].shape[0]
+        checkidx = rng.choice(npts, size=round(npts * checkpts), replace=False)
+        tasks.append((z, slices[z], checkidx, minwthick, tolsl, tolpt, tol, tolincr))
+    with ProcessPoolExecutor() as executor:
+        for z, zctrds in zip(zcoords, executor.map(_slice_centroids, tasks)):
+            ctrds[z] = zctrds
     return ctrds
 
 
@@ -188,11 +295,12 @@ def make_polylines(minwthick, zcoords, ctrds, prcnt=1, minctrd=2, simpl_tol=0.02
         # For each centroid, calculate the distance between it and the 
         # previous. If the distance is > than minwthick, then split the
         # unique polyline removing the segment between them.
+        # Squared distances are compared to avoid the square root.
         try:
-            dists = np.sqrt(np.square(ctrds[z][1:, 0] - ctrds[z][0:-1, 0])+
-                            np.square(ctrds[z][1:, 1] - ctrds[z][0:-1, 1]))
-            tails = np.where((dists >= minwthick) == True)
-            polys[z] = np.split(ctrds[z][:, : 2], tails[0] + 1)
+            dx = ctrds[z][1:, 0] - ctrds[z][:-1, 0]
+            dy = ctrds[z][1:, 1] - ctrds[z][:-1, 1]
+            tails = np.flatnonzero(dx * dx + dy * dy >= minwthick * minwthick)
+            polys[z] = np.split(ctrds[z][:, : 2], tails + 1)
         except TypeError:
             continue
 
@@ -210,103 +318,127 @@ def make_polylines(minwthick, zcoords, ctrds, prcnt=1, minctrd=2, simpl_tol=0.02
     print('tol polylines length: ', tolpolyslen)
 
     cleanpolys = {}  # Dict to be filled: key=zcoord_i, value=clean polylines
+    rawpolys = []    # Polylines to be simplified, of all the slices
+    rawpolyz = []    # z of every polyline of rawpolys
     for z in zcoords:
-        zcleanpolys = []
         try:
-            for poly in polys[z]:
-                if len(poly) < minctrd or len(poly) < tolpolyslen / 1.3: # 1.3 could be removed
-                    continue
-                rawpoly = sg.LineString(poly)
-                cleanpoly = rawpoly.simplify(simpl_tol, preserve_topology=True)
-                zcleanpolys += [np.array(cleanpoly)]
-            cleanpolys[z] = zcleanpolys
-            print(len(cleanpolys[z]), ' clean polylines found in slice ', "%.3f" % z)
+            zrawpolys = [poly for poly in polys[z] if len(poly) >= minctrd and len(poly) >= tolpolyslen / 1.3] # 1.3 could be removed
         except KeyError:
             print('Slice ', z, ' skipped, it could be empty')
             continue
+        cleanpolys[z] = []
+        rawpolys += zrawpolys
+        rawpolyz += [z] * len(zrawpolys)
+    if len(rawpolys) > 0:
+        # The polylines of all the slices are built and simplified in a single vectorized call
+        polyids = np.repeat(np.arange(len(rawpolys)), [len(poly) for poly in rawpolys])
+        rawlines = shapely.linestrings(np.vstack(rawpolys), indices=polyids)
+        cleanlines = shapely.simplify(rawlines, simpl_tol, preserve_topology=True)
+        cleancoords, cleanids = shapely.get_coordinates(cleanlines, return_index=True)
+        # The coordinates are split by the index of the polyline they belong to, which gives
+        # its z. Empty simplified polylines have no coordinates, so they are dropped here
+        lineids, starts = np.unique(cleanids, return_index=True)
+        for lineid, cleanpoly in zip(lineids, np.split(cleancoords, starts[1:])):
+            cleanpolys[rawpolyz[lineid]].append(cleanpoly)
+    for z in cleanpolys:
+        print(len(cleanpolys[z]), ' clean polylines found in slice ', "%.3f" % z)
     return polys, cleanpolys
 
 
 
 
 
-def make_polygons(minwthick, zcoords, cleanpolys, tolsimpl=0.035):
+def _slice_polygons(args):
+    """
+    args: tuple (z, zcleanpolys), where zcleanpolys are the clean polylines of the slice at z
+    
+    Returns the MultiPolygon of a single slice (None if no polygons are generated) and the
+    list of invalid polygons found in it. It is defined at module level to be executed by
+    the worker processes of make_polygons().
+    """
+    z, zcleanpolys = args
+    invalidpolygons = []  # List of invalid polygons to be filled [z, z,..]
+    pgons = []  # List of Polygons of slice z, to be filled
+    # A ring needs at least 4 coordinates once closed: the other polylines cannot become Polygons
+    plens = np.array([len(polyline) for polyline in zcleanpolys], dtype=int)
+    closed = np.array([len(polyline) > 0 and np.array_equal(polyline[0], polyline[-1])
+                       for polyline in zcleanpolys], dtype=bool)
+    isring = plens + ~closed >= 4
+    for i in range(np.count_nonzero(~isring)):
+        print('Error in slice ', z, 'Try to eliminate isolated segments')
+    newpgons = []
+    if isring.any():
+        # All the polylines are converted into shapely Polygons with a single vectorized call
+        ringids = np.repeat(np.arange(np.count_nonzero(isring)), plens[isring])
+        rings = shapely.linearrings(np.vstack([polyline for polyline, ok in zip(zcleanpolys, isring) if ok]),
+                                    indices=ringids)
+        newpgons = shapely.polygons(rings)
+    for newpgon, isvalid in zip(newpgons, shapely.is_valid(newpgons)):
+        if not isvalid:
+            # The invalid polygon is repaired by GEOS MakeValid, but the slice is still
+            # reported to the user, since the repaired geometry could need a manual check
+            invalidpolygons += [z]  # Needed to show a warning message
+            print('!!! Invalid polygon found in slice ' + "%.3f" % z + ' !!!')
+            print(shapely.is_valid_reason(newpgon))
+            # MakeValid could return a MultiPolygon or a GeometryCollection: keep only the Polygons
+            parts = shapely.get_parts(shapely.get_parts(shapely.make_valid(newpgon)))
+            pgons += list(parts[shapely.get_type_id(parts) == 3])
+            continue
+        pgons += [newpgon]
+    print('slice: ', "%.3f" % z, ', independent polygons generated: ', len(pgons))
+
+    try:
+        # Perform boolean operation between Polygons to get a unique MultiPolygon per slice z.
+        # The symmetric difference is kept (inner polylines become holes), but the Polygons are
+        # combined in pairs, so that no operation involves the whole growing geometry
+        temp = pgons[0]
+        if len(pgons) >= 2:
+            while len(pgons) > 1:
+                pgons = [pgons[j].symmetric_difference(pgons[j + 1]) if j + 1 < len(pgons) else pgons[j]
+                         for j in range(0, len(pgons), 2)]
+            return pgons[0], invalidpolygons
+        elif len(pgons) == 1:
+            return temp, invalidpolygons
+        else:
+            print('Slice: ', "%.3f" % z, '   No poligons generated')
+    except IndexError:
+        print('Index error in "temp = pgons[0]"')
+        pass
+    return None, invalidpolygons
+
+
+
+
+
+def make_polygons(minwthick, zcoords, cleanpolys):
     """
     minwthick : Minimum wall thickness
     zcoords   : 1-d np array of z coords as that returned by func "make_zcoords()"
     cleanpolys: Dict of clean polylines as that returned by func "make_polylines()"
-    tolsimpl  : Douglas-Peucker tol, used only if a polygon is invalid, default = 0.035
     
     Given the arguments, returns a dict "polygs" defined as key=zcoord_i
     and value=MultiPolygon, a common 2D geometry data structure used by
     the Shapely package.
-    The returned list invalidpolygons is only needed to help the user solve problems in the gui.
+    Invalid polygons are repaired through shapely.make_valid(); the returned list
+    invalidpolygons is only needed to help the user solve problems in the gui.
+    Slices are processed in parallel by a pool of worker processes.
     """
     # Remove empty zcoords due to manual removal of points/centroids/polylines
-    z_to_remove = []
-    for z in zcoords:
-        try:
-            for polyline in cleanpolys[z]:
-                pass
-        except KeyError:
-            z_to_remove.append(z)
-            print('removed: ', z)
-
-    for r in z_to_remove:
-        zcoords = zcoords[zcoords != r]
+    keepz = np.array([z in cleanpolys for z in zcoords], dtype=bool)
+    for z in zcoords[~keepz]:
+        print('removed: ', z)
+    zcoords = zcoords[keepz]  # A single boolean mask instead of a new array per removed z
     
     # Make Polygons 
     invalidpolygons = []  # List of invalid polygons to be filled [zcoord1, zcoord2,..]
     polygs = {}  # Dict to be filled: key=zcoord_i, value=MultiPolygon
     
-    for z in zcoords:
-        pgons = []  # List of Polygons of slice z, to be filled
-        for polyline in cleanpolys[z]:
-            try:
-                isvalid = 1
-                newpgon = sg.Polygon(polyline)  # Just converted a polyline into the shapely Polygon data structure
-            except ValueError:
-                print('Error in slice ', z, 'Try to eliminate isolated segments')
-            while True:
-                if newpgon.is_valid:
-                    break
-#########################################################################################
-### This portion of code tries to adjust an invalid polygon ############################
-                elif tolsimpl >= minwthick / 2.5 and not newpgon.is_valid:
-                    isvalid = 0
-                    invalidpolygons += [z]  # Needed to show a warning message
-                    # Generates a translated copy and performs an invalid operation to generate an useful error message
-                    tranpgon = shapely.affinity.translate(newpgon, xoff=0.005, yoff=-0.005)
-                    try:
-                        invalidoperation = newpgon.symmetric_difference(tranpgon)
-                    except Exception as e:
-                        print('!!! Invalid polygon found in slice ' + "%.3f" % z + ' !!!')
-                        print(e)
-                    break
-                else:
-                    tolsimpl += minwthick / 50
-                    newpgon.simplify(tolsimpl, preserve_topology=True)
-#########################################################################################
-            if isvalid == 0:
-                continue
-            else:
-                pgons += [newpgon]
-        print('slice: ', "%.3f" % z, ', independent polygons generated: ', len(pgons))
-
-        try:
-            # Perform boolean operation between Polygons to get a unique MultiPolygon per slice z
-            temp = pgons[0]
-            if len(pgons) >= 2:
-                for j in range(len(pgons) - 1):
-                    temp = temp.symmetric_difference(pgons[j + 1])
-                polygs[z] = temp
-            elif len(pgons) == 1:
-                polygs[z] = temp
-            else:
-                print('Slice: ', "%.3f" % z, '   No poligons generated')
-        except IndexError:
-            print('Index error in "temp = pgons[0]"')
-            pass
+    tasks = [(z, cleanpolys[z]) for z in zcoords]
+    with ProcessPoolExecutor() as executor:
+        for z, (zpolygs, zinvalid) in zip(zcoords, executor.map(_slice_polygons, tasks)):
+            if zpolygs is not None:
+                polygs[z] = zpolygs
+            invalidpolygons += zinvalid
     return polygs, invalidpolygons
 
 
@@ -322,14 +454,13 @@ def export_dxf(zcoords, polygs, filepath):
     dxfdoc = ezdxf.new('R2013')
     msp = dxfdoc.modelspace()
 
+    # The entities are built in this process: ezdxf entities are bound to their
+    # document, so they cannot be created by worker processes and pickled back
     for z in zcoords:
         pygeoint = sg.mapping(polygs[z])    # Or use asShape instead of mapping
-        dxfentities = GeoProxy.to_dxf_entities(GeoProxy.parse(pygeoint))
-        for entity in dxfentities:
+        for entity in GeoProxy.to_dxf_entities(GeoProxy.parse(pygeoint)):
             entity.rgb = (0, 133, 147)
             entity.transparency = (0.15)
             msp.add_entity(entity.translate(0, 0, z))
             
     dxfdoc.saveas(filepath)
-
-
@@ -25,12 +25,41 @@
 # as Shapely MultiPolygons, allow to derive a 3D voxel mesh that can be 
 # exported as an Abaqus .inp file.
 ###############################################################################
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import shapely.geometry as sg
+import shapely
 import time
 
 
 
+def _pixels_in_polygon(args):
+    """
+    args: tuple (polyg, xelgrid, yelgrid), where polyg is the MultiPolygon of a slice
+          and xelgrid, yelgrid are the x and y element grids defined in make_mesh()
+    
+    Returns the np array of the elements inside polyg, where each row is
+    [xelgridID, yelgridID]. It is defined at module level to be executed by
+    the worker processes of make_mesh().
+    """
+    polyg, xelgrid, yelgrid = args
+    zelems = [np.empty((0, 2), dtype=int)]
+    for pgon in getattr(polyg, 'geoms', [polyg]):
+        if pgon.is_empty:
+            continue
+        # Only the part of the grid inside the bounds of each polygon is tested
+        minx, miny, maxx, maxy = pgon.bounds
+        x0 = np.searchsorted(xelgrid, minx, side='left')
+        x1 = np.searchsorted(xelgrid, maxx, side='right')
+        y0 = np.searchsorted(yelgrid, miny, side='left')
+        y1 = np.searchsorted(yelgrid, maxy, side='right')
+        # All the element centroids are tested in a single call instead of one sg.Point at a time.
+        # The x column and y row views broadcast to the (x, y) grid, so no meshgrid is allocated
+        inside = shapely.contains_xy(pgon, xelgrid[x0: x1, np.newaxis], yelgrid[np.newaxis, y0: y1])
+        zelems.append(np.argwhere(inside) + [x0, y0])
+    return np.unique(np.vstack(zelems), axis=0)  # Rows sorted by xelgridID, then yelgridID
+
+
+
 def make_mesh(xeldim, yeldim, xmin, ymin, xmax, ymax, zcoords, polygs):
     #
     #                    Grid definition 
@@ -78,21 +107,11 @@ def make_mesh(xeldim, yeldim, xmin, ymin, xmax, ymax, zcoords, polygs):
     elemlist = {}
     tot_elements = 0  # Total number of elements
     print('Searching for "pixels" inside polygons...')
-    for z in zcoords:
-        initstack = 0
-        for x in range(len(xelgrid)):
-            for y in range(len(yelgrid)):
-                if polygs[z].contains(sg.Point(xelgrid[x], yelgrid[y])):
-                    if initstack != 0:
-                        # elemlist[z] = np.vstack((elemlist[z], np.array([x, y]))) # Python .append is much faster than np.vstack
-                        elemlist[z].append([x, y])
-                        tot_elements += 1
-                    else:
-                        # elemlist[z] = np.array([[x, y]])  # Python .append is much faster than np.vstack
-                        elemlist[z] = [[x, y]]
-                        initstack += 1
-                        tot_elements += 1
-        elemlist[z] = np.array(elemlist[z])
+    tasks = [(polygs[z], xelgrid, yelgrid) for z in zcoords]
+    with ProcessPoolExecutor() as executor:
+        for z, zelems in zip(zcoords, executor.map(_pixels_in_polygon, tasks)):
+            elemlist[z] = zelems
+            tot_elements += zelems.shape[0]
     print('Total number of elements: ', tot_elements)
     t1 = time.time()
     t = t1 - t0
@@ -103,12 +122,23 @@ def make_mesh(xeldim, yeldim, xmin, ymin, xmax, ymax, zcoords, polygs):
 
     nodeID = 1              # Initlialize node ID
     elID = 1                # Initlialize element ID
-    nodelist = []           # Initialize nodelist
-    elconnect = []          # Initialize connectivity matrix
-    ignore = []             # Initialize  the n° nodes to ignore when comparing
-    zignore = 0             # Initialize nodes found in the current slice that will be ignored later
-    
-    arr_dim = 0.5           # Percentage used to update the length of the nodelist numpy array
+    nodelist = []           # Initialize nodelist, filled with one np array per slice
+    elconnect = []          # Initialize connectivity matrix, filled with one np array per slice
+    # nodeIDs of the bottom (index 0) and top (index 1) nodes layers of the current slice,
+    # given the xngrid and yngrid indices. 0 means that the node has not been generated yet
+    layers = np.zeros((2, len(xngrid), len(yngrid)), dtype=np.int64)
+
+    #  Nodes numbering of the eight nodes brick element: top view
+    #
+    # 3 ______ 2      7 ______ 6
+    #  |      |        |      |
+    #  |bottom|        | top  |
+    #  |______|        |______|
+    # 0        1      4        5
+    #
+    # Offsets of the element nodes 0 -> 7 with respect to node 0 in xngrid, yngrid and layers
+    nodeoffsets = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                            [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]])
 
     for z in range(len(zcoords)):
         crntz = zcoords[z]              # Current z
@@ -120,97 +150,38 @@ def make_mesh(xeldim, yeldim, xmin, ymin, xmax, ymax, zcoords, polygs):
         else:
             elh = crntz - zcoords[z-1]  # Height of the elements of the last slice
         
+        # Indices of the eight nodes of every element: row i = element i, column j = node j
+        zelems = elemlist[zcoords[z]]
+        xn = zelems[:, [0]] + nodeoffsets[:, 0]
+        yn = zelems[:, [1]] + nodeoffsets[:, 1]
+        ln = np.broadcast_to(nodeoffsets[:, 2], xn.shape)
         
-        z_elconnect = []  # Initialize connectivity for the current slice
+        # Generate the missing nodes, numbered in the order they are first met element by element
+        missing = layers[ln, xn, yn] == 0
+        newkeys = np.ravel_multi_index((ln[missing], xn[missing], yn[missing]), layers.shape)
+        newkeys, first = np.unique(newkeys, return_index=True)
+        newkeys = newkeys[np.argsort(first)]
+        newIDs = np.arange(nodeID, nodeID + newkeys.shape[0])
+        layers.flat[newkeys] = newIDs
+        newl, newx, newy = np.unravel_index(newkeys, layers.shape)
+        nodelist.append(np.column_stack((newIDs, xngrid[newx], yngrid[newy], crntz + newl * elh)))
+        nodeID += newkeys.shape[0]
         
-        for elem in elemlist[zcoords[z]]:
-            
-            tempel = [elID]  # To be filled: temporary row of the connectivity matrix
-            
-            for node in range(8):  # Element node number 0 -> 7
-            
-                #  Nodes numbering of the eight nodes brick element: top view
-                #
-                # 3 ______ 2      7 ______ 6
-                #  |      |        |      |
-                #  |bottom|        | top  |
-                #  |______|        |______|
-                # 0        1      4        5
-                #
-                if node == 0:
-                    tempn = [nodeID, xngrid[elem[0]], yngrid[elem[1]], crntz]  # Temporary row of the list of nodes
-                elif node == 1:
-                    tempn = [nodeID, xngrid[elem[0] + 1], yngrid[elem[1]], crntz]  # Temporary row of the list of nodes
-                elif node == 2:
-                    tempn = [nodeID, xngrid[elem[0] + 1], yngrid[elem[1] + 1], crntz]  # Temporary row of the list of nodes
-                elif node == 3:
-                    tempn = [nodeID, xngrid[elem[0]], yngrid[elem[1] + 1], crntz]  # ....
-                elif node == 4:
-                    tempn = [nodeID, xngrid[elem[0]], yngrid[elem[1]], crntz + elh]  # ...
-                elif node == 5:
-                    tempn = [nodeID, xngrid[elem[0] + 1], yngrid[elem[1]], crntz + elh]
-                elif node == 6:
-                    tempn = [nodeID, xngrid[elem[0] + 1], yngrid[elem[1] + 1], crntz + elh]
-                elif node == 7:
-                    tempn = [nodeID, xngrid[elem[0]], yngrid[elem[1] + 1], crntz + elh]
-
-                if elID != 1:
-                    # Check if the temporary node tempn has already been generated.
-                    # If True, len(nexists)=1 and nexists[0]=index of the existing
-                    # node in nodelist that has to be appended to tempel instead of tempn
-                    
-                    if z > 2:
-                        ignoring = 1  # Comparing only with the nodes in the slice below
-                        nexistsxy = np.logical_and(tempn[1] == nodelist[ignore[z-2]:nodeID, 1], tempn[2] == nodelist[ignore[z-2]:nodeID, 2])
-                        nexists = np.where(np.logical_and(nexistsxy == True, tempn[3] == nodelist[ignore[z-2]:nodeID, 3]))[0]
-                    elif z <= 2:
-                        ignoring = 0
-                        nexistsxy = np.logical_and(tempn[1] == nodelist[:nodeID, 1], tempn[2] == nodelist[:nodeID, 2])
-                        nexists = np.where(np.logical_and(nexistsxy == True, tempn[3] == nodelist[:nodeID, 3]))[0]
-                        
-                    if len(nexists) == 1:
-                        if ignoring == 1:
-                            small_nodelist = nodelist[ignore[z - 2]:nodeID]
-                            tempel.append(small_nodelist[nexists, 0][0])
-                        elif ignoring == 0:
-                            tempel.append(nodelist[nexists, 0][0])
-                    else:
-                        try:
-                            nodelist[nodeID - 1] = tempn
-                        except IndexError:  # If the length of nodelist is not enough, add to it another piece with nan values
-                            nodelist = np.vstack((nodelist, np.array([[None, None, None, None]] * int(tot_elements * arr_dim)).astype(np.float32, copy=False)))
-                            nodelist[nodeID - 1] = tempn
-                            
-                        tempel.append(nodeID)
-                        nodeID += 1
-                        zignore += 1
-
-                elif elID == 1:
-                    # The lines of code below are used only for the first defined element
-                    if nodeID == 1:
-                        nodelist = np.array([[None, None, None, None]] * int(tot_elements * arr_dim)).astype(np.float32, copy=False)
-                        nodelist[nodeID - 1] = tempn
-                        
-                        tempel.append(nodeID)         # Add the nodeID to the temporary row of the connectivity matrix
-                        nodeID += 1
-                        zignore += 1
-                    else:
-                        nodelist[nodeID - 1] = tempn
-                        
-                        tempel.append(nodeID)         # Add the nodeID to the temporary row of the connectivity matrix    
-                        nodeID += 1
-                        zignore += 1
-
-            # Add new elements to z_elconnect
-            z_elconnect.append(tempel)
-            elID += 1
-
-        # Add z_elconnect to the list that contains all the elements
-        elconnect += z_elconnect
-        ignore.append(zignore)
+        # Add the elements of the current slice to the connectivity matrix
+        elIDs = np.arange(elID, elID + zelems.shape[0])
+        elconnect.append(np.column_stack((elIDs, layers[ln, xn, yn])))
+        elID += zelems.shape[0]
+        
+        # The top nodes layer of the current slice is the bottom one of the next slice
+        layers[0] = layers[1]
+        layers[1] = 0
     
-    nodelist = nodelist[~np.isnan(nodelist[:, 0])]
-    elconnect = np.array(elconnect)
+    nodelist = np.vstack(nodelist)
+    elconnect = np.vstack(elconnect)
+    # elconnect holds only IDs: it is stored as int32 when the last node and element IDs fit.
+    # nodelist is not, its IDs share the float64 array of the coordinates
+    if max(nodeID, elID) <= 2**31:
+        elconnect = elconnect.astype(np.int32)
     t1 = time.time()
     t = t1 - t0
     print('Connectivity generation, elapsed time: ', str(t))
@@ -222,33 +193,23 @@ def make_mesh(xeldim, yeldim, xmin, ymin, xmax, ymax, zcoords, polygs):
 
 
 
-def export_mesh(meshpath, nodelist, elconnect):
-    f = open(meshpath, "w")
+def export_mesh(meshpath, nodelist, elconnect, chunkrows=100000):
+    f = open(meshpath, "w", buffering=1024 * 1024)  # 1 MB write buffer
     
     f.write("*Heading\n** Generated by: Cloud2FEM\n")
     f.write("**\n** PARTS\n**\n*Part, name=PART-1\n")
     
+    # Nodes and elements are formatted and written in chunks of chunkrows rows, so that
+    # the text of a whole block is never held in memory together with the arrays
     f.write("*Node\n")
-    for node in nodelist:
-        nid = str(int(node[0]))
-        nx = str("%.8f" % node[1])
-        ny = str("%.8f" % node[2])
-        nz = str("%.8f" % node[3])
-        f.write("      " + nid + ",   " + nx + ",   " + ny + ",   " + nz + "\n")
+    nodefmt = "      %d,   %.8f,   %.8f,   %.8f\n"
+    for i in range(0, nodelist.shape[0], chunkrows):
+        f.write("".join([nodefmt % tuple(node) for node in nodelist[i: i + chunkrows].tolist()]))
     
     f.write("*Element, type=C3D8\n")
-    for elem in elconnect:
-        eid = str(int(elem[0]))
-        n1 = str(int(elem[1]))
-        n2 = str(int(elem[2]))
-        n3 = str(int(elem[3]))
-        n4 = str(int(elem[4]))
-        n5 = str(int(elem[5]))
-        n6 = str(int(elem[6]))
-        n7 = str(int(elem[7]))
-        n8 = str(int(elem[8]))
-        f.write(eid + ", " + n1 + ", " + n2 + ", " + n3 + ", "
-                + n4 + ", " + n5 + ", " + n6 + ", " + n7 + ", " + n8 + "\n")
+    elemfmt = "%d, %d, %d, %d, %d, %d, %d, %d, %d\n"
+    for i in range(0, elconnect.shape[0], chunkrows):
+        f.write("".join([elemfmt % tuple(elem) for elem in elconnect[i: i + chunkrows].tolist()]))
     
     f.write("*End Part\n")
     f.write("**\n**\n** ASSEMBLY\n**\n*Assembly, name=Assembly\n")
@@ -28,73 +28,180 @@ from vispy.scene import visuals
 
 
 
+def _to_gl(a):
+    """ Returns a as a contiguous float32 array (no copy if it already is one),
+    the format uploaded by vispy to OpenGL
+    """
+    return np.ascontiguousarray(a, dtype=np.float32)
+
+
+
+def _stack_gl(arrays):
+    """ Stacks the list of 3-columns arrays into a single float32 array, allocated
+    once and filled block by block (no intermediate float64 stack)
+    """
+    offsets = np.cumsum([0] + [a.shape[0] for a in arrays])
+    out = np.empty((offsets[-1], 3), dtype=np.float32)
+    for a, start, stop in zip(arrays, offsets[:-1], offsets[1:]):
+        out[start: stop] = a
+    return out
+
+
+
+
 class Visp3dplot():
     """ Class that handles all the 3DViewer graphics.
     The view is defined into the __init__ method, while
     other ad-hoc methods are used to add items to it.
+    The gui keeps a single instance, emptied by reset() and fed again at every
+    request of a 3D view, until its canvas is closed (see self.closed).
     """
     def __init__(self, resolution):
         self.resolution = resolution
+        self.rng = np.random.default_rng()  # Random generator used to subsample the point cloud
         self.canvas = vispy.scene.SceneCanvas(title='3D Viewer', keys='interactive', show=True, bgcolor='white')
+        self.closed = False  # True once the canvas is closed, then the viewer cannot be reused
+        self.canvas.events.close.connect(self.on_close)
         self.view3d = self.canvas.central_widget.add_view()
-
-    def print_cloud(self, plotdata, alpha):
-        """ :param plotdata: 3-columns np array (mct.pcl or mct.netpcl)
+        # The visuals are created once: the print methods upload new data to them and attach
+        # them to the scene (a visual without data would break the camera range computation).
+        # The draw order puts the (semi-transparent) point cloud last, as done by the gui.
+        # Centroids, slices and polyline vertices share a single Markers visual (one draw call),
+        # each of them is a layer of points with its own color, size and symbol
+        self.markers = visuals.Markers()
+        self.markers.order = 0
+        self.markerlayers = {}  # key=layer name, value=(points, face color, size, symbol)
+        self.polylines = visuals.Line(method='gl')
+        self.polylines.order = 1
+        self.scatter = visuals.Markers(spherical=False)
+        self.scatter.order = 2
+        self.axis = None  # Created by final3dsetup()
+        # Clouds bigger than tilesize points are shown progressively: the first tile goes to
+        # self.scatter, the others get their own Markers, one per tick of tiletimer
+        self.tilesize = 1000000
+        self.cloudtiles = []    # Markers of the tiles already added to the scene
+        self.pendingtiles = []  # Tiles of points still to be added
+        self.tiletimer = vispy.app.Timer(interval=0.05, connect=self.add_cloud_tile)
+
+    def on_close(self, event):
+        """ Canvas close callback """
+        self.tiletimer.stop()
+        self.closed = True
+
+    def reset(self, resolution):
+        """ Detaches all the visuals from the scene, so that the viewer can be fed again
+        by the print methods with a new resolution. The visuals and the camera are kept,
+        the canvas is shown again if its window was hidden
+        """
+        self.resolution = resolution
+        self.tiletimer.stop()
+        for tile in self.cloudtiles:
+            tile.parent = None
+        self.cloudtiles = []
+        self.pendingtiles = []
+        self.markerlayers = {}
+        for visual in (self.markers, self.polylines, self.scatter):
+            visual.parent = None
+        self.canvas.show()
+
+    def print_cloud(self, plotdata, alpha, fast=True):
+        """ :param plotdata: 3-columns np array (mct.pcl or the net point cloud outside the slices)
+            :param fast: if True, the points are drawn as plain 1 px squares (no antialiasing),
+                         which is indistinguishable from 1 px discs but much cheaper to fill
         """
-        self.scatter = visuals.Markers()
+        if fast:
+            self.scatter.antialias = 0
+            symbol = 'square'
+        else:
+            self.scatter.antialias = 1
+            symbol = 'disc'
         if self.resolution == 1:
-            self.pcl3dplotdata = plotdata
+            self.pcl3dplotdata = _to_gl(plotdata)
+        elif abs(round(1 / self.resolution) * self.resolution - 1) < 1e-9:
+            # resolution = 1/k: a stride view decimates the cloud without drawing and gathering indices
+            self.pcl3dplotdata = _to_gl(plotdata[::round(1 / self.resolution)])
         else:
             self.npts_sub = int(round(self.resolution * plotdata.shape[0]))
-            self.randpts = np.random.choice(plotdata.shape[0], size=self.npts_sub, replace=False)
-            self.pcl3dplotdata = plotdata[self.randpts]
-        self.scatter.set_data(self.pcl3dplotdata, symbol='disc',
-                              face_color=(255 / 255, 255 / 255, 255 / 255, alpha), size=1.0)   ################### default size = 2.7
-        self.view3d.add(self.scatter)
+            # The order of the subset does not matter for plotting, so it is not shuffled
+            self.randpts = self.rng.choice(plotdata.shape[0], size=self.npts_sub, replace=False, shuffle=False)
+            self.pcl3dplotdata = _to_gl(plotdata[self.randpts])
+        self.cloudstyle = dict(symbol=symbol, face_color=(255 / 255, 255 / 255, 255 / 255, alpha), size=1.0)   ################### default size = 2.7
+        # Remove the tiles of a previous cloud, then show the first tile and queue the others
+        self.tiletimer.stop()
+        for tile in self.cloudtiles:
+            tile.parent = None
+        self.cloudtiles = []
+        self.pendingtiles = [self.pcl3dplotdata[i: i + self.tilesize]
+                             for i in range(self.tilesize, self.pcl3dplotdata.shape[0], self.tilesize)]
+        self.scatter.set_data(self.pcl3dplotdata[: self.tilesize], **self.cloudstyle)
+        self.scatter.parent = self.view3d.scene
+        if self.pendingtiles:
+            self.tiletimer.start()
+
+    def add_cloud_tile(self, event):
+        """ Timer callback: adds the next pending tile of the point cloud to the scene,
+        the timer is stopped when all the tiles have been added
+        """
+        tile = visuals.Markers(spherical=False)
+        tile.order = self.scatter.order
+        tile.antialias = self.scatter.antialias
+        tile.set_data(self.pendingtiles.pop(0), **self.cloudstyle)
+        tile.parent = self.view3d.scene
+        self.cloudtiles.append(tile)
+        if not self.pendingtiles:
+            self.tiletimer.stop()
 
     def print_slices(self, mct):
-        try:
-            self.slices = visuals.Markers()
-            self.sliceplot = mct.slices[mct.zcoords[0]]
-            for i in mct.zcoords[1:]:
-                self.sliceplot = np.vstack((self.sliceplot, mct.slices[i]))
-            self.slices.set_data(self.sliceplot, symbol='disc',
-                                 face_color=(0 / 255, 0 / 255, 255 / 255, 1), size=4.3)
-            self.view3d.add(self.slices)
-        except TypeError:
+        if mct.slices is None or mct.zcoords is None:
             print("Error in Visp3dplot.print_slices(): generate the slices first")
+            return
+        # All the slices are stacked with a single copy instead of a vstack per slice
+        self.sliceplot = _stack_gl([mct.slices[i] for i in mct.zcoords])
+        self.markerlayers['slices'] = (self.sliceplot, (0 / 255, 0 / 255, 255 / 255, 1), 4.3, 'disc')
+        self.__update_markers()
 
     def print_centr(self, mct):
-        self.centroids = visuals.Markers()
-        self.centrplot = mct.ctrds[mct.zcoords[0]]
-        for i in mct.zcoords[1:]:
-            self.centrplot = np.vstack((self.centrplot, mct.ctrds[i]))
-        self.centroids.set_data(self.centrplot, symbol='disc',
-                             face_color=(255 / 255, 0 / 255, 0 / 255, 1), size=7)
-        self.view3d.add(self.centroids)
+        # Slices without centroids (None) are skipped, the others are stacked with a single copy
+        self.centrplot = _stack_gl([mct.ctrds[i] for i in mct.zcoords if mct.ctrds[i] is not None])
+        self.markerlayers['centroids'] = (self.centrplot, (255 / 255, 0 / 255, 0 / 255, 1), 7, 'disc')
+        self.__update_markers()
 
     def print_polylines(self, mct):
-        xyzplines = []
-        for z in mct.zcoords:
-            for poly in mct.cleanpolys[z]:
-                zcolumn = np.zeros((poly.shape[0], 1)) + z
-                xyzplines += [np.hstack((poly, zcolumn))]
-
-        plotitems = []
-        for i in range(len(xyzplines)):
-            plotitems += [visuals.Line()]
-            plotitems[i].set_data(xyzplines[i], color=(0.05, 0.05, 1, 1), width=1)
-            self.view3d.add(plotitems[i])
-
-        vertices = xyzplines[0]
-        for poly in xyzplines[1:]:
-            vertices = np.vstack((vertices, poly))
-        self.vertices = visuals.Markers()
-        self.vertices.set_data(vertices, symbol='square',
-                                face_color=(220 / 255, 30 / 255, 30 / 255, 1), size=2.7)
-        self.view3d.add(self.vertices)
+        # The xyz vertices of all the polylines are written into a single preallocated array:
+        # xy with one concatenation, z by repeating the height of each polyline
+        polys = [poly for z in mct.zcoords for poly in mct.cleanpolys[z]]
+        plens = [poly.shape[0] for poly in polys]
+        offsets = np.cumsum([0] + plens)
+        vertices = np.empty((offsets[-1], 3), dtype=np.float32)
+        np.concatenate(polys, axis=0, out=vertices[:, :2], casting='same_kind')
+        vertices[:, 2] = np.repeat([z for z in mct.zcoords for poly in mct.cleanpolys[z]], plens)
+
+        # All the polylines are drawn by a single Line visual: the segments joining
+        # the last vertex of a polyline to the first one of the next are disabled
+        connect = np.ones(vertices.shape[0] - 1, dtype=bool)
+        connect[offsets[1: -1] - 1] = False
+        self.polylines.set_data(vertices, color=(0.05, 0.05, 1, 1), width=1, connect=connect)
+        self.polylines.parent = self.view3d.scene
+
+        self.markerlayers['vertices'] = (vertices, (220 / 255, 30 / 255, 30 / 255, 1), 2.7, 'square')
+        self.__update_markers()
+
+    def __update_markers(self):
+        """ Uploads all the layers of self.markerlayers to the shared Markers visual,
+        with per-point colors, sizes and symbols
+        """
+        layers = [self.markerlayers[key] for key in ('centroids', 'slices', 'vertices') if key in self.markerlayers]
+        npts = [layer[0].shape[0] for layer in layers]
+        self.markers.set_data(_stack_gl([layer[0] for layer in layers]),
+                              face_color=np.repeat(np.array([layer[1] for layer in layers], dtype=np.float32), npts, axis=0),
+                              size=np.repeat(np.array([layer[2] for layer in layers], dtype=np.float32), npts),
+                              symbol=np.repeat([layer[3] for layer in layers], npts))
+        self.markers.parent = self.view3d.scene
 
     def final3dsetup(self):
-        self.view3d.camera = 'turntable'  # 'turntable'  # or 'arcball'
-        axis = visuals.XYZAxis(parent=self.view3d.scene)
+        # Camera and axis are created only once, so a second call does not reset the view
+        if not isinstance(self.view3d.camera, vispy.scene.cameras.TurntableCamera):
+            self.view3d.camera = 'turntable'  # 'turntable'  # or 'arcball'
+        if self.axis is None:
+            self.axis = visuals.XYZAxis(parent=self.view3d.scene)
 
@@ -20,9 +20,11 @@
 
 
 
+import os
 import shelve
 import numpy as np
 from pyntcloud import PyntCloud
+import shapely
 import shapely.geometry as sg
 import sys
 from PyQt5 import QtWidgets
@@ -41,7 +43,7 @@ import plot2D as ptd
 class MainContainer:
     def __init__(self, filepath=None, pcl=None, npts=None, zmin=None, zmax=None,
                  xmin=None, xmax=None, ymin=None, ymax=None, zcoords=None,
-                 slices=None, netpcl=None, ctrds=None, polys=None, cleanpolys=None,
+                 slices=None, netmask=None, ctrds=None, polys=None, cleanpolys=None,
                  polygs=None, xngrid=None, xelgrid=None, yngrid=None, yelgrid=None,
                  elemlist=None, nodelist=None, elconnect=None, temp_points=None,
                  temp_scatter=None, temp_polylines=None, temp_roi_plot=None,
@@ -57,7 +59,7 @@ class MainContainer:
         self.ymax = ymax
         self.zcoords = zcoords      # 1D Numpy array of z coordinates utilized to create the slices below
         self.slices = slices        # Dictionary where key(i)=zcoords(i) and value(i)=np_array_xy(i)
-        self.netpcl = netpcl        # pcl with empty spaces at slices position (for 3D visualization purposes)
+        self.netmask = netmask      # np.packbits of the pcl mask of the points outside the slices (for 3D visualization purposes)
         self.ctrds = ctrds          # Dictionary ordered as done for dict "slices"
         self.polys = polys          # Dict key(i) = zcoords(i), value(i) = [[np.arr.poly1],[np.a.poly2],[..],[np.polyn]]
         self.cleanpolys = cleanpolys  # Polylines cleaned by the shapely simplify function
@@ -76,20 +78,110 @@ class MainContainer:
 mct = MainContainer()  # All the main variables are stored here
 
 
+def flatten_arrays(arrays):
+    """ arrays: list of 2D np arrays (or None)
+    
+    Returns the np array of their shapes ([-1, -1] for None) and a single
+    1D np array where all the values are stored one after the other
+    """
+    shapes = np.array([(-1, -1) if a is None else a.shape for a in arrays], dtype=np.int64).reshape(-1, 2)
+    values = [a.ravel() for a in arrays if a is not None]
+    return shapes, np.concatenate(values) if values else np.empty(0)
+
+
+
+def split_arrays(shapes, data):
+    """ Inverse of flatten_arrays(): returns the list of arrays (views of data)
+    """
+    sizes = np.where(shapes[:, 0] < 0, 0, shapes[:, 0] * shapes[:, 1])
+    ends = np.cumsum(sizes)
+    return [None if r < 0 else data[e - n: e].reshape(r, c) for (r, c), n, e in zip(shapes, sizes, ends)]
+
+
+
+def nan_separated(polys):
+    """ polys: list of polylines as np arrays (the first two columns are x, y)
+    
+    Returns a single 2-columns np array of all the polylines, each one followed by
+    a row of NaNs, so that they can be plotted as a single curve with connect='finite'
+    """
+    ends = np.cumsum([poly.shape[0] + 1 for poly in polys])
+    xy = np.full((ends[-1] if len(polys) else 0, 2), np.nan)
+    for poly, end in zip(polys, ends):
+        xy[end - 1 - poly.shape[0]: end - 1] = poly[:, : 2]
+    return xy
+
+
+
+def pack_project(mctdict):
+    """ mctdict: dict of the MainContainer attributes to be saved
+    
+    Returns a dict of np arrays to be saved with np.savez_compressed: dicts of arrays
+    (key=z) and dicts of lists of arrays are stored as flat buffers plus shapes,
+    MultiPolygons as WKB bytes. None values are not stored.
+    """
+    packed = {}
+    for k, v in mctdict.items():
+        if v is None:
+            continue
+        elif k in ['slices', 'ctrds', 'elemlist']:  # key=z, value=np array
+            packed[k + '_keys'] = np.array(list(v.keys()), dtype=np.float64)
+            packed[k + '_shapes'], packed[k + '_data'] = flatten_arrays(list(v.values()))
+        elif k in ['polys', 'cleanpolys']:          # key=z, value=list of np arrays
+            packed[k + '_keys'] = np.array(list(v.keys()), dtype=np.float64)
+            packed[k + '_counts'] = np.array([len(plines) for plines in v.values()], dtype=np.int64)
+            packed[k + '_shapes'], packed[k + '_data'] = flatten_arrays([a for plines in v.values() for a in plines])
+        elif k == 'polygs':                           # key=z, value=MultiPolygon
+            wkbs = [pgon.wkb for pgon in v.values()]
+            packed[k + '_keys'] = np.array(list(v.keys()), dtype=np.float64)
+            packed[k + '_wkblens'] = np.array([len(wkb) for wkb in wkbs], dtype=np.int64)
+            packed[k + '_wkb'] = np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+        else:
+            packed[k] = np.asarray(v)
+    return packed
+
+
+
+def unpack_project(f):
+    """ f: mapping of np arrays, as returned by np.load() for a file written with pack_project()
+    
+    Returns the dict of the saved MainContainer attributes
+    """
+    mctdict = {}
+    for k in f.files:
+        if k.endswith('_keys'):
+            name = k[: -5]
+            keys = f[k]
+            if name in ['polys', 'cleanpolys']:
+                polylines = split_arrays(f[name + '_shapes'], f[name + '_data'])
+                ends = np.cumsum(f[name + '_counts'])
+                mctdict[name] = {z: polylines[e - n: e] for z, n, e in zip(keys, f[name + '_counts'], ends)}
+            elif name == 'polygs':
+                ends = np.cumsum(f[name + '_wkblens'])
+                wkb = f[name + '_wkb'].tobytes()
+                mctdict[name] = {z: shapely.from_wkb(wkb[e - n: e]) for z, n, e in zip(keys, f[name + '_wkblens'], ends)}
+            else:
+                mctdict[name] = dict(zip(keys, split_arrays(f[name + '_shapes'], f[name + '_data'])))
+        elif not k.endswith(('_shapes', '_data', '_counts', '_wkblens', '_wkb')):
+            mctdict[k] = f[k][()]
+    return mctdict
+
+
+
 def save_project():
     try:
         fd = QFileDialog()
         filepath = fd.getSaveFileName(parent=None, caption="Save Project", directory="",
                                       filter="Cloud2FEM Data (*.cloud2fem)")[0]
-        s = shelve.open(filepath)
-        mct_dict = mct.__dict__  # Special method: convert instance of a class to a dict
-        for k in mct_dict.keys():
-            if k in ['filepath', 'pcl', 'netpcl', 'editmode', 'roiIndex', 
-                     'temp_roi_plot', 'temp_polylines', 'temp_scatter', 'temp_points']:
-                continue
-            else:
-                s[k] = mct_dict[k]
-        s.close()
+        if filepath == '':
+            raise ValueError
+        if not filepath.endswith('.cloud2fem'):
+            filepath += '.cloud2fem'
+        mct_dict = {k: v for k, v in mct.__dict__.items()  # Special method: convert instance of a class to a dict
+                    if k not in ['filepath', 'pcl', 'netmask', 'editmode', 'roiIndex',
+                                 'temp_roi_plot', 'temp_polylines', 'temp_scatter', 'temp_points']}
+        # A single compressed file, np.savez_compressed adds the .npz extension
+        np.savez_compressed(filepath, **pack_project(mct_dict))
     except (ValueError, TypeError, FileNotFoundError):
         print('No file name specified')
 
@@ -97,36 +189,41 @@ def open_project():
         try:
             fd = QFileDialog()
             filepath = fd.getOpenFileName(parent=None, caption="Open Project", directory="",
-                                         filter="Cloud2FEM Data (*.cloud2fem.dat)")[0]
-            s = shelve.open(filepath[: -4])
-
-            mct.npts = s['npts']
-            mct.zmin = s['zmin']
-            mct.zmax = s['zmax']
-            mct.xmin = s['xmin']
-            mct.xmax = s['xmax']
-            mct.ymin = s['ymin']
-            mct.ymax = s['ymax']
-            try:
-                mct.zcoords = s['zcoords']
-            except KeyError:
-                mct.zcoords = s['zslices']
-            mct.slices = s['slices']
-            mct.ctrds = s['ctrds']
-            mct.polys = s['polys']
-            mct.cleanpolys = s['cleanpolys']
-            mct.polygs = s['polygs']
-            mct.xngrid = s['xngrid']
-            mct.xelgrid = s['xelgrid']
-            mct.yngrid = s['yngrid']
-            mct.yelgrid = s['yelgrid']
-            mct.elemlist = s['elemlist']
-            mct.nodelist = s['nodelist']
-            mct.elconnect = s['elconnect']
-            s.close()
-
-            for z in mct.zcoords:
-                win.combo_slices.addItem(str('%.3f' % z))
+                                         filter="Cloud2FEM Data (*.cloud2fem.npz *.cloud2fem.dat)")[0]
+            if filepath.endswith('.dat'):
+                # Projects saved by the previous versions through shelve
+                s = shelve.open(filepath[: -4])
+                data = dict(s)
+                s.close()
+            else:
+                with np.load(filepath) as f:
+                    data = unpack_project(f)
+
+            mct.npts = data.get('npts')
+            mct.zmin = data.get('zmin')
+            mct.zmax = data.get('zmax')
+            mct.xmin = data.get('xmin')
+            mct.xmax = data.get('xmax')
+            mct.ymin = data.get('ymin')
+            mct.ymax = data.get('ymax')
+            mct.zcoords = data.get('zcoords', data.get('zslices'))
+            mct.slices = data.get('slices')
+            mct.ctrds = data.get('ctrds')
+            mct.polys = data.get('polys')
+            mct.cleanpolys = data.get('cleanpolys')
+            mct.polygs = data.get('polygs')
+            mct.xngrid = data.get('xngrid')
+            mct.xelgrid = data.get('xelgrid')
+            mct.yngrid = data.get('yngrid')
+            mct.yelgrid = data.get('yelgrid')
+            mct.elemlist = data.get('elemlist')
+            mct.nodelist = data.get('nodelist')
+            mct.elconnect = data.get('elconnect')
+
+            # All the items are added at once with signals blocked, then the plot is refreshed once
+            win.combo_slices.blockSignals(True)
+            win.combo_slices.addItems(np.char.mod('%.3f', mct.zcoords).tolist())
+            win.combo_slices.blockSignals(False)
             win.main2dplot()
 
             win.label_zmin_value.setText(str(mct.zmin))
@@ -142,22 +239,22 @@ def open_project():
             win.check_pcl.setEnabled(False)
             win.btn_edit.setEnabled(True)
 
-            if mct.ctrds != None:
+            if mct.ctrds is not None:
                 win.check_centroids.setEnabled(True)
                 win.status_centroids.setStyleSheet("background-color: rgb(0, 255, 0);")
                 win.btn_gen_polylines.setEnabled(True)
                 win.radioCentroids.setEnabled(True)
-            if mct.cleanpolys != None:
+            if mct.cleanpolys is not None:
                 win.check_polylines.setEnabled(True)
                 win.status_polylines.setStyleSheet("background-color: rgb(0, 255, 0);")
                 win.btn_gen_polygons.setEnabled(True)
                 win.radioPolylines.setEnabled(True)
                 win.btn_copy_plines.setEnabled(True)
-            if mct.polygs != None:
+            if mct.polygs is not None:
                 win.status_polygons.setStyleSheet("background-color: rgb(0, 255, 0);")
                 win.btn_gen_mesh.setEnabled(True)
                 win.exp_dxf.setEnabled(True)
-            if mct.elemlist != None:
+            if mct.elemlist is not None:
                 win.status_mesh.setStyleSheet("background-color: rgb(0, 255, 0);")
                 win.exp_mesh.setEnabled(True)
 
@@ -166,6 +263,50 @@ def open_project():
 
 
 
+def load_binary_pcd(filepath):
+    """ filepath: path of a .pcd file
+    
+    Returns the 3-columns xyz np array (float32) of a binary .pcd file whose x, y and z
+    fields are float32, read through a memory map instead of a pandas DataFrame.
+    Returns None for any other .pcd file (ascii or compressed data, other field types),
+    which has to be loaded by PyntCloud
+    """
+    header = {}
+    with open(filepath, 'rb') as f:
+        while 'DATA' not in header:
+            line = f.readline()
+            if not line:
+                return None
+            words = line.decode('ascii', errors='replace').split()
+            if words and not words[0].startswith('#'):
+                header[words[0]] = words[1:]
+        offset = f.tell()  # The binary data starts right after the DATA line
+    try:
+        fields, sizes, types = header['FIELDS'], [int(s) for s in header['SIZE']], header['TYPE']
+        counts = [int(c) for c in header.get('COUNT', ['1'] * len(fields))]
+        npts = int(header['POINTS'][0])
+    except (KeyError, ValueError, IndexError):
+        return None
+    if header['DATA'] != ['binary'] or not {'x', 'y', 'z'} <= set(fields) or len(sizes) != len(fields):
+        return None
+    fieldoffsets = np.cumsum([0] + [s * c for s, c in zip(sizes, counts)])
+    xyz = [fields.index(c) for c in ('x', 'y', 'z')]
+    if any(types[i] != 'F' or sizes[i] != 4 or counts[i] != 1 for i in xyz):
+        return None
+    # Each point is a record of itemsize bytes, of which only x, y and z are read
+    pointdtype = np.dtype({'names': ['x', 'y', 'z'], 'formats': ['<f4'] * 3,
+                           'offsets': [int(fieldoffsets[i]) for i in xyz], 'itemsize': int(fieldoffsets[-1])})
+    if os.path.getsize(filepath) < offset + npts * pointdtype.itemsize:
+        return None
+    points = np.memmap(filepath, dtype=pointdtype, mode='r', offset=offset, shape=(npts,))
+    pcl = np.empty((npts, 3), dtype=np.float32)
+    for i, c in enumerate(('x', 'y', 'z')):
+        pcl[:, i] = points[c]
+    del points  # Closes the memory map
+    return pcl
+
+
+
 def loadpcl():
     """ Opens a FileDialog to choose the PCl and stores the
     values for filepath, pcl, npts, zmin and zmax. Then sets up the gui.
@@ -175,49 +316,28 @@ def loadpcl():
         getfile = fd.getOpenFileName(parent=None, caption="Load Point Cloud", directory="",
                                      filter="Point Cloud Data (*.pcd);; Polygon File Format (*.ply)")
         mct.filepath = getfile[0]
-        wholepcl = PyntCloud.from_file(mct.filepath)
-        mct.npts = wholepcl.points.shape[0]          # Point Cloud number of points
-
-        # Defines a 3-columns xyz numpy array
-        mct.pcl = np.hstack((
-            np.array(wholepcl.points['x']).reshape(mct.npts, 1),
-            np.array(wholepcl.points['y']).reshape(mct.npts, 1),
-            np.array(wholepcl.points['z']).reshape(mct.npts, 1)
-        ))
-        mct.zmin = mct.pcl[:, 2].min()
+        # Binary .pcd files with float32 xyz are read directly, the others are loaded by PyntCloud
+        mct.pcl = load_binary_pcd(mct.filepath) if mct.filepath.lower().endswith('.pcd') else None
+        if mct.pcl is None:
+            wholepcl = PyntCloud.from_file(mct.filepath)
+            # Defines a 3-columns xyz numpy array in a single pass, float32 is enough and halves the memory traffic
+            mct.pcl = np.ascontiguousarray(wholepcl.points[['x', 'y', 'z']].to_numpy(dtype=np.float32))
+        mct.npts = mct.pcl.shape[0]          # Point Cloud number of points
+
+        # Bounding box of the point cloud with two reductions instead of one per coordinate
+        mct.xmin, mct.ymin, mct.zmin = mct.pcl.min(axis=0)
+        mct.xmax, mct.ymax, mct.zmax = mct.pcl.max(axis=0)
         win.label_zmin_value.setText(str(mct.zmin))
-        mct.zmax = mct.pcl[:, 2].max()
         win.label_zmax_value.setText(str(mct.zmax))
-        mct.xmin = mct.pcl[:, 0].min()
-        mct.xmax = mct.pcl[:, 0].max()
-        mct.ymin = mct.pcl[:, 1].min()
-        mct.ymax = mct.pcl[:, 1].max()
         print("\nPoint Cloud of " + str(mct.pcl.shape[0]) + " points loaded, file path: " + mct.filepath)
         print("First three points:\n" + str(mct.pcl[:3]))
         print("Last three points:\n" + str(mct.pcl[-3:]))
         if len(mct.filepath) < 65:
             win.loaded_file.setText("Loaded Point Cloud: " + mct.filepath + "   ")
         else:
-            slashfound = 0
-            head_reverse = ''
-            for char in mct.filepath[:30][::-1]:
-                if char == '/' and slashfound == 0:
-                    slashfound += 1
-                elif slashfound == 0:
-                    continue
-                else:
-                    head_reverse += char
-            path_head = head_reverse[::-1]
-
-            slashfound = 0
-            path_tail = ''
-            for char in mct.filepath[30:]:
-                if char == '/' and slashfound == 0:
-                    slashfound += 1
-                elif slashfound == 0:
-                    continue
-                else:
-                    path_tail += char
+            # Qt file dialogs always return '/' as separator, also on Windows
+            path_head = mct.filepath[:30].rpartition('/')[0]  # Up to the last '/' of the first 30 chars
+            path_tail = mct.filepath[30:].partition('/')[2]   # After the first '/' of the remaining chars
             win.loaded_file.setText("Loaded Point Cloud: " + path_head + '/...../' + path_tail + "   ")
             win.status_slices.setStyleSheet("background-color: rgb(255, 0, 0);")
             win.status_centroids.setStyleSheet("background-color: rgb(255, 0, 0);")
@@ -282,6 +402,9 @@ class Window(QMainWindow):
         # Set some default values
         self.emode = None  # Edit mode status
         self.staticPlotItems = []  # List of non editable plotted items
+        self.gridcache = None      # (grid parameters, curve item) of the last grid plotted by plot_grid
+        self.itemcache = {}        # key=(layer, z), value=(plotted data, list of items), see cached_items
+        self.p3d = None            # 3D viewer, reused by open3dview
 
 
 
@@ -307,10 +430,15 @@ class Window(QMainWindow):
                 else:
                     pass
                     
-                mct.slices, mct.netpcl = cp.make_slices(mct.zcoords, mct.pcl, float(d), mct.npts)
+                mct.slices, mct.netmask = cp.make_slices(mct.zcoords, mct.pcl, float(d), mct.npts)
+                # Populates the gui slices combobox at once, with signals blocked so that
+                # main2dplot() is called only once instead of on every index change
+                self.itemcache = {}  # The cached plot items of the previous slices are dropped
+                self.combo_slices.blockSignals(True)
                 self.combo_slices.clear()
-                for z in mct.zcoords:
-                    self.combo_slices.addItem(str('%.3f' % z))  # Populates the gui slices combobox
+                self.combo_slices.addItems(np.char.mod('%.3f', mct.zcoords).tolist())
+                self.combo_slices.blockSignals(False)
+                self.main2dplot()
                 
                 print(len(mct.slices.keys()), ' slices generated')
                 self.lineEdit_wall_thick.setEnabled(True)
@@ -479,11 +607,18 @@ class Window(QMainWindow):
         chkctr = self.check_centroids.isChecked()
         chkply = self.check_polylines.isChecked()
         if self.rbtn_100.isChecked():
-            p3d = Visp3dplot(1)
+            resolution = 1
         elif self.rbtn_50.isChecked():
-            p3d = Visp3dplot(0.5)
+            resolution = 0.5
         else:
-            p3d = Visp3dplot(0.1)
+            resolution = 0.1
+        # The same viewer (canvas and visuals) is fed again at every click, a new one
+        # is created only the first time or after its canvas has been closed
+        if self.p3d is None or self.p3d.closed:
+            self.p3d = Visp3dplot(resolution)
+        else:
+            self.p3d.reset(resolution)
+        p3d = self.p3d
         if chkctr:
             p3d.print_centr(mct)
         if chksli:
@@ -491,7 +626,9 @@ class Window(QMainWindow):
         if chkply:
             p3d.print_polylines(mct)
         if chkpcl and (chksli or chkctr or chkply):
-            p3d.print_cloud(mct.netpcl, 0.5)   ############################################ default alpha = 0.75
+            # The pcl with empty spaces at slices position is built only here, from the packed mask
+            netpcl = mct.pcl[np.unpackbits(mct.netmask, count=mct.npts).view(bool)]
+            p3d.print_cloud(netpcl, 0.5)   ############################################ default alpha = 0.75
         elif chkpcl:
             p3d.print_cloud(mct.pcl, 1)
         p3d.final3dsetup()
@@ -499,47 +636,76 @@ class Window(QMainWindow):
     def plot_grid(self):
         xeldim = float(self.lineEdit_xeldim.text())
         yeldim = float(self.lineEdit_yeldim.text())
-        xngrid = np.arange(mct.xmin - xeldim, mct.xmax + 2 * xeldim, xeldim)
-        yngrid = np.arange(mct.ymin - yeldim, mct.ymax + 2 * yeldim, yeldim)
-        for x in xngrid:
-            xitem = pg.PlotCurveItem(pen=pg.mkPen(color=(220, 220, 220, 255), width=1.5))
-            xitem.setData(np.array([x, x]), np.array([min(yngrid), max(yngrid)]))
-            self.plot2d.addItem(xitem)
-            self.staticPlotItems.append(xitem)
-        for y in yngrid:
-            yitem = pg.PlotCurveItem(pen=pg.mkPen(color=(220, 220, 220, 255), width=1.5))
-            yitem.setData(np.array([min(xngrid), max(xngrid)]), np.array([y, y]))
-            self.plot2d.addItem(yitem)
-            self.staticPlotItems.append(yitem)
+        gridparams = (xeldim, yeldim, mct.xmin, mct.xmax, mct.ymin, mct.ymax)
+        if self.gridcache is None or self.gridcache[0] != gridparams:
+            xngrid = np.arange(mct.xmin - xeldim, mct.xmax + 2 * xeldim, xeldim)
+            yngrid = np.arange(mct.ymin - yeldim, mct.ymax + 2 * yeldim, yeldim)
+            # All the grid lines are stored in a single curve: each line is made
+            # by its two end points followed by a NaN that breaks the curve
+            nx = len(xngrid)
+            xgrid = np.full(3 * (nx + len(yngrid)), np.nan)
+            ygrid = np.full(3 * (nx + len(yngrid)), np.nan)
+            xgrid[0: 3 * nx: 3], ygrid[0: 3 * nx: 3] = xngrid, yngrid[0]          # Vertical lines
+            xgrid[1: 3 * nx: 3], ygrid[1: 3 * nx: 3] = xngrid, yngrid[-1]
+            xgrid[3 * nx:: 3], ygrid[3 * nx:: 3] = xngrid[0], yngrid              # Horizontal lines
+            xgrid[3 * nx + 1:: 3], ygrid[3 * nx + 1:: 3] = xngrid[-1], yngrid
+            griditem = pg.PlotCurveItem(xgrid, ygrid, connect='finite',
+                                        pen=pg.mkPen(color=(220, 220, 220, 255), width=1.5))
+            self.gridcache = (gridparams, griditem)
+        # If the grid did not change, the same item is simply added again
+        self.plot2d.addItem(self.gridcache[1])
+        self.staticPlotItems.append(self.gridcache[1])
+
+    def current_z(self):
+        """ Returns the z of the slice selected in the combobox. It is not cached on
+        currentIndexChanged, since the combobox is filled with its signals blocked
+        """
+        return mct.zcoords[self.combo_slices.currentIndex()]
+
+    def cached_items(self, layer, z, data, build):
+        """ Returns the plot items of a layer of slice z, built by build(data) only the first
+        time. The items are rebuilt when data is not the same object plotted before
+        (the data of a slice is replaced, not modified in place, when it is regenerated or edited)
+        """
+        cached = self.itemcache.get((layer, z))
+        if cached is None or cached[0] is not data:
+            cached = (data, build(data))
+            self.itemcache[(layer, z)] = cached
+        for item in cached[1]:
+            self.plot2d.addItem(item)
+            self.staticPlotItems.append(item)
 
     def plot_slice(self):
-        slm2dplt = mct.slices[mct.zcoords[self.combo_slices.currentIndex()]][:, [0, 1]]
-        scatter2d = pg.ScatterPlotItem(pos=slm2dplt, size=5, brush=pg.mkBrush(0, 0, 0, 255))    #### default size = 5
-        self.plot2d.addItem(scatter2d)
-        self.staticPlotItems.append(scatter2d)
+        z = self.current_z()
+        # x and y are passed as column views: no copy of the slice and no per-spot construction
+        self.cached_items('slice', z, mct.slices[z], lambda slm2dplt: [
+            pg.ScatterPlotItem(x=slm2dplt[:, 0], y=slm2dplt[:, 1], size=5, brush=pg.mkBrush(0, 0, 0, 255))])    #### default size = 5
 
     def plot_centroids(self):
-        ctrsm2dplt = mct.ctrds[mct.zcoords[self.combo_slices.currentIndex()]][:, [0, 1]]
-        ctrsscatter2d = pg.ScatterPlotItem(pos=ctrsm2dplt, size=9, brush=pg.mkBrush(255, 0, 0, 255)) ######### default size = 13
-        self.plot2d.addItem(ctrsscatter2d)
-        self.staticPlotItems.append(ctrsscatter2d)
+        z = self.current_z()
+        self.cached_items('centroids', z, mct.ctrds[z], lambda ctrsm2dplt: [
+            pg.ScatterPlotItem(x=ctrsm2dplt[:, 0], y=ctrsm2dplt[:, 1], size=9, brush=pg.mkBrush(255, 0, 0, 255))]) ######### default size = 13
 
     def plot_polylines(self):
-        for poly in mct.polys[mct.zcoords[self.combo_slices.currentIndex()]]:
-            item = pg.PlotCurveItem(pen=pg.mkPen(color=(0, 0, 255, 255), width=3))
-            item.setData(poly[:, 0], poly[:, 1])
-            self.plot2d.addItem(item)
-            self.staticPlotItems.append(item)
+        z = self.current_z()
+        # All the polylines of the slice are drawn as a single NaN-separated curve
+        def build(polys):
+            if len(polys) == 0:
+                return []
+            xy = nan_separated(polys)
+            return [pg.PlotCurveItem(xy[:, 0], xy[:, 1], connect='finite', pen=pg.mkPen(color=(0, 0, 255, 255), width=3))]
+        self.cached_items('polylines', z, mct.polys[z], build)
     
     def plot_polys_clean(self):
-        for poly in mct.cleanpolys[mct.zcoords[self.combo_slices.currentIndex()]]:
-            item = pg.PlotCurveItem(pen=pg.mkPen(color=(0, 0, 0, 255), width=5))
-            item.setData(poly[:, 0], poly[:, 1])
-            self.plot2d.addItem(item)
-            self.staticPlotItems.append(item)
-            pts = pg.ScatterPlotItem(pos=poly[:, : 2], size=9, brush=pg.mkBrush(255, 0, 0, 255), symbol='s')
-            self.plot2d.addItem(pts)
-            self.staticPlotItems.append(pts)
+        z = self.current_z()
+        # A single NaN-separated curve for all the clean polylines and a single scatter for their vertices
+        def build(cleanpolys):
+            if len(cleanpolys) == 0:
+                return []
+            xy = nan_separated(cleanpolys)
+            return [pg.PlotCurveItem(xy[:, 0], xy[:, 1], connect='finite', pen=pg.mkPen(color=(0, 0, 0, 255), width=5)),
+                    pg.ScatterPlotItem(pos=np.vstack(cleanpolys)[:, : 2], size=9, brush=pg.mkBrush(255, 0, 0, 255), symbol='s')]
+        self.cached_items('cleanpolylines', z, mct.cleanpolys[z], build)
             
 
     def main2dplot(self):
@@ -552,6 +718,8 @@ class Window(QMainWindow):
         for item in self.staticPlotItems:
             self.plot2d.removeItem(item)
         self.staticPlotItems = []
+        if not (chk2dsli or chk2centr or chk2dplines or chk2dplclean or chk2dgrid):
+            return  # Nothing to plot
         try:
             try:
                 if chk2dgrid:
@@ -669,21 +837,24 @@ class Window(QMainWindow):
             self.plot2d.setTitle('R remove points (click), <strong><u><big><mark>P remove points (rect selection)</strong>')
             self.emode = 'points'
             self.pointsTool = 'removerect'
-            self.tempPoints = mct.slices[mct.zcoords[self.combo_slices.currentIndex()]].copy()
+            # No copy is needed: the edit tools never modify the array in place (RemovePointsRect
+            # builds a new one at every removal, RemovePointsClick flags the removed points in its
+            # alive mask), so the slice is untouched until saved
+            self.tempPoints = mct.slices[self.current_z()]
             self.editInstance = [ptd.RemovePointsRect(self.tempPoints, self.plot2d, 10)]
             self.editInstance[0].start()
         elif self.radioCentroids.isChecked():
             self.plot2d.setTitle('R remove points (click), <strong><u><big><mark>P remove points (rect selection)</strong>')
             self.emode = 'centroids'
             self.pointsTool = 'removerect'
-            self.tempCentroids = mct.ctrds[mct.zcoords[self.combo_slices.currentIndex()]].copy()
+            self.tempCentroids = mct.ctrds[self.current_z()]  # No copy, as above
             self.editInstance = [ptd.RemovePointsRect(self.tempCentroids, self.plot2d, 10)]
             self.editInstance[0].start()
         elif self.radioPolylines.isChecked():
             self.plot2d.setTitle('<strong><u><big><mark>D draw</strong>, J join, R remove polyline, A add point, M move point, P remove points, O offset')
             self.emode = 'polylines'
             self.polylinesTool = 'draw'
-            self.tempPolylines = mct.cleanpolys[mct.zcoords[self.combo_slices.currentIndex()]].copy()
+            self.tempPolylines = mct.cleanpolys[self.current_z()].copy()
             self.editInstance = [ptd.DrawPolyline(self.tempPolylines, self.plot2d, 10)]
             self.editInstance[0].start()
 
@@ -702,7 +873,7 @@ class Window(QMainWindow):
                         self.tempPolylines.append(edI.pts_b)
                 else:
                     self.tempPolylines = edI.plls      
-            mct.cleanpolys[mct.zcoords[self.combo_slices.currentIndex()]] = self.tempPolylines
+            mct.cleanpolys[self.current_z()] = self.tempPolylines
             self.polylinesTool = 'draw'
             self.emode = None
             self.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
@@ -711,23 +882,27 @@ class Window(QMainWindow):
         elif self.emode == 'points':
             for edI in self.editInstance:
                 edI.stop()
-            mct.slices[mct.zcoords[self.combo_slices.currentIndex()]] = self.editInstance[0].pts_b
+            # The edit tools only remove points: if pts_b has as many points as the
+            # original slice nothing changed, and the next steps are not invalidated
+            if self.editInstance[0].pts_b.shape[0] != mct.slices[self.current_z()].shape[0]:
+                mct.slices[self.current_z()] = self.editInstance[0].pts_b
+                self.status_centroids.setStyleSheet("background-color: rgb(255, 0, 0);")
+                self.status_polylines.setStyleSheet("background-color: rgb(255, 0, 0);")
+                self.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
+                self.status_mesh.setStyleSheet("background-color: rgb(255, 0, 0);")
             self.pointsTool = 'remove'
             self.emode = None
-            self.status_centroids.setStyleSheet("background-color: rgb(255, 0, 0);")
-            self.status_polylines.setStyleSheet("background-color: rgb(255, 0, 0);")
-            self.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
-            self.status_mesh.setStyleSheet("background-color: rgb(255, 0, 0);")
 
         elif self.emode == 'centroids':
             for edI in self.editInstance:
                 edI.stop()
-            mct.ctrds[mct.zcoords[self.combo_slices.currentIndex()]] = self.editInstance[0].pts_b
+            if self.editInstance[0].pts_b.shape[0] != mct.ctrds[self.current_z()].shape[0]:  # Some centroid was removed
+                mct.ctrds[self.current_z()] = self.editInstance[0].pts_b
+                self.status_polylines.setStyleSheet("background-color: rgb(255, 0, 0);")
+                self.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
+                self.status_mesh.setStyleSheet("background-color: rgb(255, 0, 0);")
             self.pointsTool = 'remove'
             self.emode = None
-            self.status_polylines.setStyleSheet("background-color: rgb(255, 0, 0);")
-            self.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
-            self.status_mesh.setStyleSheet("background-color: rgb(255, 0, 0);")
     
         self.combo_slices.setEnabled(True)
         self.btn_edit.setEnabled(True)
@@ -794,32 +969,37 @@ class Window(QMainWindow):
         copydialog.setWindowTitle("Copy slice's polylines")
         copydialog.combo_copy_pl.clear()
 
-        for z in mct.zcoords:
-            copydialog.combo_copy_pl.addItem(str('%.3f' % z))
+        zlabels = np.char.mod('%.3f', mct.zcoords).tolist()
+        copydialog.combo_copy_pl.addItems(zlabels)
+
+        # One checkable item per slice, in the order of mct.zcoords: item i refers to mct.zcoords[i]
+        paste_list = copydialog.list_paste_pl
+        paste_list.addItems(zlabels)
+        for i in range(paste_list.count()):
+            paste_list.item(i).setFlags(paste_list.item(i).flags() | Qt.ItemIsUserCheckable)
+            paste_list.item(i).setCheckState(Qt.Unchecked)
 
-        paste_slice = []
-        for z in mct.zcoords:
-            slice_index = np.where(z == mct.zcoords[:])[0][0]
-            paste_slice += [QtWidgets.QCheckBox()]
-            paste_slice[slice_index].setText(str('%.3f' % z))
-            copydialog.scrollArea_lay.layout().addWidget(paste_slice[slice_index])
+        def set_all(state):
+            paste_list.blockSignals(True)
+            for i in range(paste_list.count()):
+                paste_list.item(i).setCheckState(state)
+            paste_list.blockSignals(False)
 
         def sel_all():
-            for checkbox in paste_slice:
-                checkbox.setChecked(True)
+            set_all(Qt.Checked)
 
         def desel_all():
-            for checkbox in paste_slice:
-                checkbox.setChecked(False)
+            set_all(Qt.Unchecked)
 
         def cancel():
             copydialog.close()
 
         def copy_ok():
             tocopy = mct.cleanpolys[mct.zcoords[copydialog.combo_copy_pl.currentIndex()]]
-            for i in range(len(paste_slice)):
-                if paste_slice[i].isChecked():
-                    mct.cleanpolys[mct.zcoords[i]] = tocopy
+            for i in range(paste_list.count()):
+                if paste_list.item(i).checkState() == Qt.Checked:
+                    # The polyline arrays are shared, not copied: the edit tools never change them in place
+                    mct.cleanpolys[mct.zcoords[i]] = list(tocopy)
             win.status_polygons.setStyleSheet("background-color: rgb(255, 0, 0);")
             win.status_mesh.setStyleSheet("background-color: rgb(255, 0, 0);")
             copydialog.close()
@@ -831,8 +1011,10 @@ class Window(QMainWindow):
         copydialog.exec_()
 
 
-app = QApplication(sys.argv)
-win = Window()
-win.show()
-sys.exit(app.exec_())
+if __name__ == '__main__':
+    # The guard avoids opening the gui again in the worker processes used by cp and pf
+    app = QApplication(sys.argv)
+    win = Window()
+    win.show()
+    sys.exit(app.exec_())
 
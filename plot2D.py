@@ -25,22 +25,63 @@
 #################################################################################
 import numpy as np
 import pyqtgraph as pg
+import shapely
 from shapely.geometry import LineString
 
 
 
+def _first_segment_near(starts, ends, x, y, px, py, tol=3.5):
+    """
+    starts, ends: 2-columns np arrays of the first and last points of the segments
+    x, y        : Mouse position in view coordinates
+    px, py      : Size of a pixel in view coordinates (ViewBox.viewPixelSize())
+    tol         : Maximum distance in pixels (half the clickable width of 7 px)
+    
+    Returns the index of the first segment whose distance from the mouse,
+    measured in pixels, is not bigger than tol; None if there is no such segment
+    """
+    a = (starts[:, : 2] - (x, y)) / (px, py)  # Segments in pixels, mouse at the origin
+    d = (ends[:, : 2] - starts[:, : 2]) / (px, py)
+    dd = np.einsum('ij,ij->i', d, d)
+    t = np.clip(-np.einsum('ij,ij->i', a, d) / np.where(dd == 0, 1, dd), 0, 1)  # Closest point parameter
+    c = a + t[:, np.newaxis] * d
+    hit = np.flatnonzero(np.einsum('ij,ij->i', c, c) <= tol ** 2)
+    return int(hit[0]) if hit.shape[0] > 0 else None
+
+
+
+def _polyline_near(pll, x, y, px, py):
+    """
+    pll         : np array of a polyline, the first two columns are x and y
+    x, y, px, py: As in _first_segment_near
+    
+    Returns True if the polyline passes within half the clickable width from the mouse.
+    A polyline with a single vertex is tested as a zero-length segment, i.e. as a point
+    """
+    if pll.shape[0] < 2:
+        return _first_segment_near(pll, pll, x, y, px, py) is not None
+    return _first_segment_near(pll[: -1], pll[1:], x, y, px, py) is not None
+
+
+
 class RemovePointsClick:
     """
     Class that handles data and signals to remove points by clicking on them.
     See example 1 at the bottom of this module.
     """
     def __init__(self, pts_b, PlotItem, psz, pclr=(90, 0, 0, 255), hclr='g', verbose=False):
-        self.pts_b = pts_b       # np array of points before (_b) the click event
+        self.pts_i = pts_b       # np array of the initial points, never reallocated
+        self.alive = np.ones(pts_b.shape[0], dtype=bool)  # False for the removed points
         self.PlotItem = PlotItem # pyqtgraph plot item
         self.psz = psz           # Size of points
         self.pclr = pclr         # Color of the points
         self.hclr = hclr         # Color or the hover
         self.verbose = verbose   # If True, plots the emptying pts_b at every click
+    
+    @property
+    def pts_b(self):
+        """ np array of the points not removed yet (pts_i itself if no point was removed) """
+        return self.pts_i if self.alive.all() else self.pts_i[self.alive]
         
     def __remove_points_click(self, plot, points, ev):
         """
@@ -49,13 +90,14 @@ class RemovePointsClick:
         points       : list of points that have been clicked
         This private method removes the clicked points from a given array pts_b
         """
+        # The rows of ScatterItem are the rows of pts_i, so the index of each clicked spot
+        # is the row to be removed. The removed spots are only hidden (hidden spots can not
+        # be clicked): neither pts_i nor the ScatterItem data are reallocated at every click
         for p in points:
-            x_p = tuple(p.pos())[0]  # x coord of the clicked point
-            y_p = tuple(p.pos())[1]  # y coord of the clicked point
-            self.pts_b = np.delete(self.pts_b, np.where(np.logical_and(x_p == self.pts_b[:, 0], y_p == self.pts_b[:, 1])), 0)
-            if self.verbose:
-                print("Remaining points:\n", self.pts_b)
-        self.ScatterItem.setData(self.pts_b[:, 0], self.pts_b[:, 1])
+            self.alive[p.index()] = False
+            p.setVisible(False)
+        if self.verbose:
+            print("Remaining points:\n", self.pts_b)
         
     def start(self):
         """
@@ -71,7 +113,7 @@ class RemovePointsClick:
             hoverable=True,
             hoverPen=pg.mkPen(self.hclr, width=self.psz/15),
             hoverSize=self.psz*1.3)
-        self.ScatterItem.addPoints(self.pts_b[:, 0], self.pts_b[:, 1])
+        self.ScatterItem.addPoints(self.pts_i[:, 0], self.pts_i[:, 1])
         self.PlotItem.addItem(self.ScatterItem)
         self.ScatterItem.sigClicked.connect(self.__remove_points_click)
     
@@ -113,11 +155,13 @@ class RemovePointsRect:
         
         elif self.click == 1:  # So this is the second click
             pos_click2 = self.PlotItem.vb.mapSceneToView(pos)
-            # Remove selected points
-            toremove_x = np.logical_and(self.pts_b[:, 0] >= min(self.pos_click1.x(), pos_click2.x()), self.pts_b[:, 0] <= max(self.pos_click1.x(), pos_click2.x()))
-            toremove_y = np.logical_and(self.pts_b[:, 1] >= min(self.pos_click1.y(), pos_click2.y()), self.pts_b[:, 1] <= max(self.pos_click1.y(), pos_click2.y()))
-            toremove = np.where(np.logical_and(toremove_x, toremove_y))
-            self.pts_b = np.delete(self.pts_b, toremove, 0)
+            # Remove selected points: the rectangle bounds are computed once and the points
+            # outside it are kept with a single boolean mask
+            xmin, xmax = sorted((self.pos_click1.x(), pos_click2.x()))
+            ymin, ymax = sorted((self.pos_click1.y(), pos_click2.y()))
+            x, y = self.pts_b[:, 0], self.pts_b[:, 1]
+            inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+            self.pts_b = self.pts_b[~inside]
             # Refresh plot
             self.ScatterItem.setData(self.pts_b[:, 0], self.pts_b[:, 1])
             
@@ -137,17 +181,19 @@ class RemovePointsRect:
     def __draw_temp_rect(self, event):
         """ This method plots a transparent selection rectangle, AutoCAD style.
         """
-        if self.pos_click1!= None and self.click == 1:
+        if self.pos_click1 is not None and self.click == 1:
             pos = event  # The position for sigMouseMoved is already in Scene Coordinates
             mpos = self.PlotItem.vb.mapSceneToView(pos)  # Where the mouse is after the first click ... moving
-            # Update first three sides of the rectangle
-            rectx = [self.pos_click1.x(), mpos.x(), mpos.x(), self.pos_click1.x()]
-            recty = [self.pos_click1.y(), self.pos_click1.y(), mpos.y(), mpos.y()]
-            self.temp_rect.setData(rectx, recty)
+            x1, y1 = self.pos_click1.x(), self.pos_click1.y()
+            mx, my = mpos.x(), mpos.y()
+            # Update first three sides of the rectangle (the buffers are overwritten, not reallocated)
+            self.dragrectx[:] = (x1, mx, mx, x1)
+            self.dragrecty[:] = (y1, y1, my, my)
+            self.temp_rect.setData(self.dragrectx, self.dragrecty)
             # Update closing line of the rectangle
-            linex = [self.pos_click1.x(), self.pos_click1.x()]
-            liney = [self.pos_click1.y(), mpos.y()]
-            self.line.setData(linex, liney)
+            self.draglinex[:] = x1
+            self.dragliney[:] = (y1, my)
+            self.line.setData(self.draglinex, self.dragliney)
             
     def start(self):
         """ When called, this method plots the initial points, then plots
@@ -163,8 +209,7 @@ class RemovePointsRect:
             self.PlotItem.addItem(self.CurveItem)
         
         # Plot points
-        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush= pg.mkBrush(self.pclr))
-        self.ScatterItem.addPoints(self.pts_b[:, 0], self.pts_b[:, 1])
+        self.ScatterItem = pg.ScatterPlotItem(x=self.pts_b[:, 0], y=self.pts_b[:, 1], pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
         self.PlotItem.addItem(self.ScatterItem)
         # Create the first three sides of the rectangle
         xfactor = self.pts_b[:, 0].mean().item()
@@ -183,6 +228,11 @@ class RemovePointsRect:
         self.PlotItem.addItem(self.line)
         fill = pg.FillBetweenItem(self.temp_rect, self.line, brush=pg.mkBrush(self.sclr))
         self.PlotItem.addItem(fill)
+        # Buffers of the rectangle drawn while the mouse moves, allocated once
+        self.dragrectx = np.empty(4)
+        self.dragrecty = np.empty(4)
+        self.draglinex = np.empty(2)
+        self.dragliney = np.empty(2)
         # Set default values of counters
         self.pos_click1 = None   # Coords of the first click
         self.click = 0           # If=0 no click has been done, if=1 the first click has been done
@@ -217,6 +267,7 @@ class MovePoint:
         self.hclr = hclr            # Color or the hover
         self.tclr = tclr            # Color of the temporary moving point
         self.verbose = verbose      # If True, plots the changing pll after the action is completed
+        self.pllcopied = False      # pll is copied before its first change, since it can be shared
     
     def __init_moving_point(self, plot, points, ev):
         """ plot, points and ev are automatically assigned when this private
@@ -229,11 +280,21 @@ class MovePoint:
         if len(points) != 1: # Do nothing if two or more points have been clicked together
             pass
         else:
-            x_p = tuple(points[0].pos())[0]  # x coord of the clicked point
-            y_p = tuple(points[0].pos())[1]  # y coord of the clicked point
-            self.point_id = np.where(np.logical_and(x_p == self.pll[:, 0], y_p == self.pll[:, 1]))
-            temp_pts = np.delete(self.pll, np.where(np.logical_and(x_p == self.pll[:, 0], y_p == self.pll[:, 1])), 0)
-            self.ScatterItem.setData(temp_pts[:, 0], temp_pts[:, 1])
+            pos = points[0].pos()
+            x_p = pos.x()  # x coord of the clicked point
+            y_p = pos.y()  # y coord of the clicked point
+            if not self.pllcopied:
+                # Copy on write: the given polyline may be shared with other slices
+                # (see copy_polylines in the gui) and must not change if the edit is discarded
+                self.pll = self.pll.copy()
+                self.pllcopied = True
+            # Rows of pll equal to the clicked point, found with a single boolean mask
+            exact = self.pll[:, 0] == x_p
+            exact &= self.pll[:, 1] == y_p
+            self.point_id = int(np.flatnonzero(exact)[0])  # Row of the point to be moved
+            self.old_pt = self.pll[self.point_id].copy()   # Restored if the move is not completed
+            keep = ~exact
+            self.ScatterItem.setData(self.pll[keep, 0], self.pll[keep, 1])
             self.TempPoint.addPoints([x_p], [y_p])
             self.temp_pt = np.array([x_p, y_p])
             self.click = 1
@@ -262,7 +323,7 @@ class MovePoint:
                 self.conflict1 = False
             else:
                 # Update np array with the final position of the moved point
-                self.pll[self.point_id[0][0]] = np.array([x_p, y_p])
+                self.pll[self.point_id] = (x_p, y_p)
                 if self.verbose:
                     print(self.pll)
                 # Update scatter plot and polyline plot
@@ -287,11 +348,11 @@ class MovePoint:
             mpos = self.PlotItem.vb.mapSceneToView(pos)  # Where the mouse is after the first click ... moving
             # Update the position of the temp moving point
             self.TempPoint.setData([mpos.x()], [mpos.y()])
-            # Update the shape of the polyline
+            # Update the shape of the polyline: the moving point is written directly in self.pll
+            # (its initial position is restored by stop() if the move is not completed)
             if self.addline:
-                temp_pll = self.pll
-                temp_pll[self.point_id[0][0]] = np.array([mpos.x(), mpos.y()])
-                self.CurveItem.setData(temp_pll[:, 0], temp_pll[:, 1])
+                self.pll[self.point_id] = (mpos.x(), mpos.y())
+                self.CurveItem.setData(self.pll[:, 0], self.pll[:, 1])
     
     def start(self):
         """ When called, this method plots the initial points throuth self.ScatterItem,
@@ -334,7 +395,11 @@ class MovePoint:
         self.PlotItem.scene().sigMouseClicked.connect(self.__finalize_moving_point)
     
     def stop(self):
-        """ If called, this method disconnects all the signals """
+        """ If called, this method disconnects all the signals and puts back
+        a point whose move has been started but not completed
+        """
+        if self.click == 1:
+            self.pll[self.point_id] = self.old_pt
         self.ScatterItem.sigClicked.disconnect(self.__init_moving_point)
         self.PlotItem.scene().sigMouseClicked.disconnect(self.__finalize_moving_point)
         try:
@@ -364,28 +429,35 @@ class AddPointOnLine:
         self.verbose = verbose      # If True, plots the changing pll after the action is completed
     
     def __getSegment(self, event):
-        """ This method changes the color of the segment under the mouse pointer and 
-        then saves the key of the dictionary self.segments in self.tomodify
+        """ This method highlights the segment under the mouse pointer and 
+        then saves its index (segment i joins self.pll[i] and self.pll[i + 1]) in self.tomodify
         """
         pos = event  # The position for sigMouseMoved is already in Scene Coordinates
         mpos = self.PlotItem.vb.mapSceneToView(pos)  # Mouse position
-        # Highlight the element under the mouse pointer and save its key in self.tomodify
-        if self.invisible_polyline.mouseShape().contains(mpos):
-            found = False  # Counter to avoid selecting two segments together
-            discarded = 0
-            for key in self.segments:
-                if self.segments[key][0].mouseShape().contains(mpos) and found == False:
-                    self.segments[key][0].setPen(pg.mkPen(color=self.hlclr, width=self.lwdth*1.3))
-                    self.tomodify = key  # Dict's key of the selected segment where to add a point (after a click)
-                    found = True
-                else:
-                    self.segments[key][0].setPen(pg.mkPen(color=self.lclr, width=self.lwdth))
-                    discarded += 1
-                if discarded == len(self.segments):
-                    self.tomodify = None
-            found = False
+        tomodify = None  # Index of the segment under the mouse pointer
+        px, py = self.PlotItem.vb.viewPixelSize()
+        x, y = mpos.x(), mpos.y()
+        # Only the segments whose bounding box, enlarged by half the clickable
+        # width (7 px) plus a margin, contains the mouse are tested. Most of the mouse
+        # events are far from the polyline: the bounding box of the whole polyline is checked first
+        if self.xmin - 4 * px <= x <= self.xmax + 4 * px and self.ymin - 4 * py <= y <= self.ymax + 4 * py:
+            near = np.flatnonzero((self.segmin[:, 0] - 4 * px <= x) & (x <= self.segmax[:, 0] + 4 * px) &
+                                  (self.segmin[:, 1] - 4 * py <= y) & (y <= self.segmax[:, 1] + 4 * py))
         else:
-            self.tomodify = None
+            near = np.empty(0, dtype=int)
+        if near.shape[0] > 0:
+            # The first segment found, to avoid selecting two segments together
+            hit = _first_segment_near(self.pll[near], self.pll[near + 1], x, y, px, py)
+            if hit is not None:
+                tomodify = int(near[hit])
+        # Highlight the segment under the mouse pointer with the overlay curve and save
+        # its index in self.tomodify. The overlay is updated only when the segment changes
+        if tomodify != self.tomodify:
+            if tomodify is None:
+                self.HoverItem.setData([], [])
+            else:
+                self.HoverItem.setData(self.pll[tomodify: tomodify + 2, 0], self.pll[tomodify: tomodify + 2, 1])
+            self.tomodify = tomodify  # Index of the selected segment where to add a point (after a click)
     
     def __addPoint(self, event):
         """ This method adds the position of the click in the np array 
@@ -397,115 +469,65 @@ class AddPointOnLine:
             pos_click = self.PlotItem.vb.mapSceneToView(pos)
             x_p = pos_click.x()
             y_p = pos_click.y()
-            # Insert the click position in the middle of the selected segment
-            self.segments[self.tomodify][1] = np.insert(self.segments[self.tomodify][1], 1, [x_p, y_p], axis=0)
-            # Use the segments (only one of them is updated and has 3 points) to reassemble the polyline
-            tempstack = np.array([[None, None]])
-            for key in self.segments:
-                tempstack = np.vstack((tempstack, self.segments[key][1]))
-            tempstack = np.delete(tempstack, 0, axis=0).astype(dtype=np.float32, copy=False)            
-            newpolyline = np.array([[None, None]]).astype(dtype=np.float32, copy=False)
-            for row in tempstack:
-                if np.any(row != newpolyline[-1]):
-                    newpolyline = np.vstack((newpolyline, row))
-                else:
-                    continue
-            newpolyline = np.delete(newpolyline, 0, axis=0)
-            # Update the polyline attribute self.pll with the new reassembled one
-            self.pll = newpolyline.astype(dtype=np.float32, copy=False)
+            # Insert the click position in the middle of the selected segment, i.e. after its first vertex.
+            # Update the polyline attribute self.pll with the new one
+            self.pll = np.insert(self.pll, self.tomodify + 1, [x_p, y_p], axis=0)  # Still contiguous float32
             if self.verbose:
                 print("\n\nMODIFIED\n", self.pll)
-            # Clean up the plot and segments dictionary
-            for key in self.segments:
-                self.PlotItem.removeItem(self.segments[key][0])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.segments = {}
-            # Setup again segments and plot
-            self.__setupItems()
+            # Refresh the polyline, the bounding boxes and the vertices
+            self.__setBounds()
+            self.tomodify = None
+            self.HoverItem.setData([], [])
+            self.CurveItem.setData(self.pll[:, 0], self.pll[:, 1])
+            self.ScatterItem.addPoints([x_p], [y_p])
     
-    def __refresh_clickable_area(self):
-        """ This method solves the problem that happen when after a point has
-        been added with a lot of zoom, it is not possible to click on the segment
-        if the user zooms out.
+    def __setBounds(self):
+        """ This method computes the bounding boxes of the segments (row i = segment i)
+        and the bounding box of the whole polyline, used by __getSegment
         """
-        # Get ViewBox's viewrange info
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        new_xwidth = viewrange[0][1] - viewrange[0][0]
-        # Update everything only if the user has zoomed more than a threshold
-        if np.absolute((self.xwidth - new_xwidth) / self.xwidth) > 0.55:
-            # Disconnect signals to avoid problems (Maybe useless)
-            self.PlotItem.scene().sigMouseMoved.disconnect(self.__getSegment)
-            self.PlotItem.scene().sigMouseClicked.disconnect(self.__addPoint)
-            # Update self.xwidth
-            self.xwidth = new_xwidth
-            # Clean up plot and populate it again (through __setupItems)
-            for key in self.segments:
-                self.PlotItem.removeItem(self.segments[key][0])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.segments = {}
-            self.__setupItems()
-            # Reconnect signals
-            self.PlotItem.scene().sigMouseMoved.connect(self.__getSegment)
-            self.PlotItem.scene().sigMouseClicked.connect(self.__addPoint)
+        self.segmin = np.minimum(self.pll[: -1, : 2], self.pll[1:, : 2])
+        self.segmax = np.maximum(self.pll[: -1, : 2], self.pll[1:, : 2])
+        if len(self.pll) < 2:  # A single vertex has no segments: empty bounding box, nothing is ever hovered
+            self.xmin = self.ymin = np.inf
+            self.xmax = self.ymax = -np.inf
+            return
+        self.xmin, self.ymin = self.segmin.min(axis=0).tolist()
+        self.xmax, self.ymax = self.segmax.max(axis=0).tolist()
 
     def __setupItems(self):
-        """ This method creates a dict of segments from the polyline and
-        plots them and the points at the vertices of the polyline.
+        """ This method plots the polyline as a single curve, the (empty) curve that
+        highlights the segment under the mouse and the points at the vertices of the polyline.
         """
-        # Create a dict with key=int, value=[PlotCurveItem, segment=np.array 2x2]
-        self.segments = {}
-        for i in range(self.pll.shape[0]-1):
-            x = np.array([self.pll[i, 0], self.pll[i+1, 0]])
-            y = np.array([self.pll[i, 1], self.pll[i+1, 1]])
-            CurveItem = pg.PlotCurveItem(
-            pen=pg.mkPen(color=self.lclr, width=self.lwdth))
-            CurveItem.setClickable(False, width=7)
-            #### CurveItem.setSkipFiniteCheck(True)   ## Needed recent version of pyqtgraph
-            CurveItem.setData(x, y)
-            self.PlotItem.addItem(CurveItem)
-            xy = np.hstack((x.reshape(2, 1), y.reshape(2, 1))).astype(dtype=np.float32, copy=False)
-            self.segments[i] = [CurveItem, xy]
-            
-        # This invisible_polyline avoids to keep looping
-        # on all the segments when the mouse is far from the polyline
-        self.invisible_polyline = pg.PlotCurveItem(
-            pen=pg.mkPen((255, 255, 0, 0), width=1))
-        self.invisible_polyline.setClickable(False, width=100)
-        self.PlotItem.addItem(self.invisible_polyline)
-        self.invisible_polyline.setData(self.pll[:, 0], self.pll[:, 1])
+        self.CurveItem = pg.PlotCurveItem(pen=pg.mkPen(color=self.lclr, width=self.lwdth))
+        self.CurveItem.setData(self.pll[:, 0], self.pll[:, 1])
+        self.PlotItem.addItem(self.CurveItem)
+        self.HoverItem = pg.PlotCurveItem(pen=pg.mkPen(color=self.hlclr, width=self.lwdth*1.3))
+        self.PlotItem.addItem(self.HoverItem)
+        self.__setBounds()
+        self.tomodify = None  # No segment is highlighted yet
         # Plot points at the vertices of the polyline
-        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush= pg.mkBrush(self.pclr))
-        self.ScatterItem.addPoints(self.pll[:, 0], self.pll[:, 1])
+        self.ScatterItem = pg.ScatterPlotItem(x=self.pll[:, 0], y=self.pll[:, 1], pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
         self.PlotItem.addItem(self.ScatterItem)
 
     def start(self):
         """ This method starts everything just as the other classes above.
         Call it after an instance of this class has been created.
         """
-        # Change the np array type, maybe needed only if input data
-        # is a test array of integers
-        self.pll = self.pll.astype(dtype=np.float32, copy=False)
+        # The polyline is converted once to a contiguous float32 array (needed if input data
+        # is a test array of integers)
+        self.pll = np.ascontiguousarray(self.pll, dtype=np.float32)
         if self.verbose:
             print("\n\n\nINITIAL\n", self.pll)
-        # Initialize plots and data and connect signals
+        # Initialize plots and data and connect signals. The segments are hit-tested in pixels
+        # at the current zoom, so nothing has to be refreshed when the view range changes
         self.__setupItems()
         self.PlotItem.scene().sigMouseMoved.connect(self.__getSegment)
         self.PlotItem.scene().sigMouseClicked.connect(self.__addPoint)
-        self.PlotItem.sigRangeChanged.connect(self.__refresh_clickable_area)
-        # Get initial viewrange of the ViewBox, needed only for
-        # __refresh_clickable_area method
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        self.xwidth = viewrange[0][1] - viewrange[0][0]
         
     def stop(self):
         """ If called, this method disconnects all the signals """
         self.PlotItem.scene().sigMouseMoved.disconnect(self.__getSegment)
         self.PlotItem.scene().sigMouseClicked.disconnect(self.__addPoint)
-        self.PlotItem.sigRangeChanged.disconnect(self.__refresh_clickable_area)
 
 
 
@@ -529,117 +551,90 @@ class RemovePolyline:
         self.verbose = verbose      # If True, plots the changing pll after the action is completed
     
     def __getPolyline(self, event):
-        """ This method changes the color of the pollyline under the mouse pointer and 
-        then saves the key of the dictionary self.CurveItem (corresponding to the index of
-        the self.plls item that has to be removed) in self.tomodify
+        """ This method highlights the pollyline under the mouse pointer and 
+        then saves its index in self.plls (the item that has to be removed) in self.tomodify
         """
         pos = event  # The position for sigMouseMoved is already in Scene Coordinates
         mpos = self.PlotItem.vb.mapSceneToView(pos)  # Mouse position
-        # Highlight the element under the mouse pointer and save its key in self.tomodify
-        if self.invisible_polyline.mouseShape().contains(mpos):
-            found = False  # Counter to avoid selecting two segments together
-            discarded = 0
-            for key in self.CurveItems:
-                if self.CurveItems[key].mouseShape().contains(mpos) and found == False:
-                    self.CurveItems[key].setPen(pg.mkPen(color=self.hlclr, width=self.lwdth*1.3))
-                    self.tomodify = key  # Dict's key of the selected segment where to add a point (after a click)
-                    found = True
-                else:
-                    self.CurveItems[key].setPen(pg.mkPen(color=self.lclr, width=self.lwdth))
-                    discarded += 1
-                if discarded == len(self.CurveItems):
-                    self.tomodify = None
-            found = False
-        else:
-            self.tomodify = None
+        tomodify = None  # Index of the polyline under the mouse pointer
+        # Only the polylines whose bounding box intersects a square around the mouse, whose half side
+        # is half the clickable width (7 px) plus a margin, are tested segment by segment.
+        # They are found through the STRtree of the polylines, without scanning all of them
+        px, py = self.PlotItem.vb.viewPixelSize()
+        x, y = mpos.x(), mpos.y()
+        near = np.sort(self.treekeys[self.tree.query(shapely.box(x - 4 * px, y - 4 * py, x + 4 * px, y + 4 * py))])
+        for i in near:
+            if _polyline_near(self.plls[i], x, y, px, py):
+                tomodify = int(i)  # The first polyline found, to avoid selecting two polylines together
+                break
+        # Highlight the polyline under the mouse pointer with the overlay curve and save
+        # its index in self.tomodify. The overlay is updated only when the polyline changes
+        if tomodify != self.tomodify:
+            if tomodify is None:
+                self.HoverItem.setData([], [])
+            else:
+                self.HoverItem.setData(self.plls[tomodify][:, 0], self.plls[tomodify][:, 1])
+            self.tomodify = tomodify  # Index of the polyline to be removed (after a click)
     
     def __popPolyline(self, event):
         """ This method removes the clicked polyline from the list self.plls 
         through the standard python pop method, then refreshes everything.
         """
         if self.tomodify is not None:  # self.tomodify is set in __Polyline method
-            # Disconnect signal for refresh function to avoid plot problems
-            self.PlotItem.sigRangeChanged.disconnect(self.__refresh_clickable_area)
             # Remove the clicked polyline from the list
             self.plls.pop(self.tomodify)
             # Update the polyline attribute self.pll with the new reassembled one
             if self.verbose:
                 print("\nNew number of polylines: ", len(self.plls))
-            # Clean up the plot and CurveItems dictionary
-            for key in self.CurveItems:
-                self.PlotItem.removeItem(self.CurveItems[key])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.CurveItems = {}
-            # Setup again plot and data
-            self.__setupItems()
-            # Reconnect signal
-            self.PlotItem.sigRangeChanged.connect(self.__refresh_clickable_area)
+            # Refresh the data of the plot items
+            self.__setData()
     
-    def __refresh_clickable_area(self):
-        """ This method solves the problem that happen when after a point has
-        been added with a lot of zoom, it is not possible to click on the segment
-        if the user zooms out.
-        
-        !! For this RemovePolyline class this method could be disconnected
-        to improve performances, or maybe just set a higher threshold !!
-        """
-        # Get ViewBox's viewrange info
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        new_xwidth = viewrange[0][1] - viewrange[0][0]
-        # Update everything only if the user has zoomed more than a threshold
-        if np.absolute((self.xwidth - new_xwidth) / self.xwidth) > 0.7:
-            # Disconnect signals to avoid problems (Maybe useless)
-            self.PlotItem.scene().sigMouseMoved.disconnect(self.__getPolyline)
-            self.PlotItem.scene().sigMouseClicked.disconnect(self.__popPolyline)
-            # Update self.xwidth
-            self.xwidth = new_xwidth
-            # Clean up plot and populate it again (through __setupItems)
-            for key in self.CurveItems:
-                self.PlotItem.removeItem(self.CurveItems[key])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.CurveItems = {}
-            self.__setupItems()
-            # Reconnect signals
-            self.PlotItem.scene().sigMouseMoved.connect(self.__getPolyline)
-            self.PlotItem.scene().sigMouseClicked.connect(self.__popPolyline)
-
-    def __setupItems(self):
-        """ This method creates a dict of curveitems from the polylines and
-        plots them and the points at the vertices of the polyline.
+    def __setData(self):
+        """ This method sets the data of the plot items created by __setupItems:
+        all the polylines as a single curve, the (empty) curve that highlights the
+        polyline under the mouse and the points at the vertices of the polylines.
         """
+        self.tomodify = None  # No polyline is highlighted yet
+        self.HoverItem.setData([], [])
         try:
-            # Create a dict with key=int corresponding to the self.plls index
-            # and value = PlotCurveItem_ith
-            self.CurveItems = {}
-            for i in range(len(self.plls)):
-                CurveItem = pg.PlotCurveItem(
-                pen=pg.mkPen(color=self.lclr, width=self.lwdth))
-                CurveItem.setClickable(False, width=7)
-                #### CurveItem.setSkipFiniteCheck(True)   ## Needed recent version of pyqtgraph
-                CurveItem.setData(self.plls[i][:, 0], self.plls[i][:, 1])
-                self.PlotItem.addItem(CurveItem)
-                self.CurveItems[i] = CurveItem
-                
-            # This invisible_polyline avoids to keep looping
-            # on all the polylines when the mouse pointer is far from them
-            polylines_linked = self.plls[0]
-            for pll in self.plls[1:]:
-                polylines_linked = np.vstack((polylines_linked, pll))
-            self.invisible_polyline = pg.PlotCurveItem(
-                pen=pg.mkPen((255, 255, 0, 0), width=1))
-            self.invisible_polyline.setClickable(False, width=100)
-            self.invisible_polyline.setData(polylines_linked[:, 0], polylines_linked[:, 1])
-            self.PlotItem.addItem(self.invisible_polyline)
-            # Plot points at the vertices of the polylines
-            self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush= pg.mkBrush(self.pclr))
-            self.ScatterItem.addPoints(polylines_linked[:, 0], polylines_linked[:, 1])
-            self.PlotItem.addItem(self.ScatterItem)
+            # Spatial index of the polylines (item i = self.plls[self.treekeys[i]]), used by __getPolyline
+            self.tree = shapely.STRtree([])
+            self.treekeys = np.empty(0, dtype=int)
+            if len(self.plls) == 0:
+                raise IndexError
+            polylines_linked = np.vstack(self.plls)  # A single copy instead of a vstack per polyline
+            plens = np.array([pll.shape[0] for pll in self.plls])
+            # A LineString needs at least two vertices: the polylines left with a single
+            # vertex (e.g. by the P tool) are indexed as points, so they can still be removed
+            islines = plens >= 2
+            singles = np.flatnonzero(plens == 1)
+            lines = shapely.linestrings(polylines_linked[np.repeat(islines, plens), : 2],
+                                        indices=np.repeat(np.arange(np.count_nonzero(islines)), plens[islines]))
+            points = shapely.points(polylines_linked[(np.cumsum(plens) - plens)[singles], : 2])
+            self.treekeys = np.concatenate((np.flatnonzero(islines), singles))
+            self.tree = shapely.STRtree(np.concatenate((lines, points)))
+            # The last vertex of each polyline is not connected to the first one of the next
+            connect = np.ones(polylines_linked.shape[0], dtype=bool)
+            connect[np.cumsum(plens) - 1] = False
+            self.CurveItem.setData(polylines_linked[:, 0], polylines_linked[:, 1], connect=connect)
+            self.ScatterItem.setData(polylines_linked[:, 0], polylines_linked[:, 1])
         except IndexError:
+            self.CurveItem.setData([], [], connect='all')
+            self.ScatterItem.setData([], [])
             print('\nNo more polylines to delete!')
 
+    def __setupItems(self):
+        """ This method creates the plot items once, then sets their data.
+        When a polyline is removed only their data is updated (see __setData).
+        """
+        self.CurveItem = pg.PlotCurveItem(pen=pg.mkPen(color=self.lclr, width=self.lwdth))
+        self.PlotItem.addItem(self.CurveItem)
+        self.HoverItem = pg.PlotCurveItem(pen=pg.mkPen(color=self.hlclr, width=self.lwdth*1.3))
+        self.PlotItem.addItem(self.HoverItem)
+        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
+        self.PlotItem.addItem(self.ScatterItem)
+        self.__setData()
+
     def start(self):
         """ This method starts everything just as the other classes above.
         Call it after an instance of this class has been created.
@@ -647,21 +642,15 @@ class RemovePolyline:
         if self.verbose:
             print("\nInitial number of polylines: ", len(self.plls))
             print(self.plls)
-        # Initialize plots and data and connect signals
+        # Initialize plots and data and connect signals. The polylines are hit-tested in pixels
+        # at the current zoom, so nothing has to be refreshed when the view range changes
         self.__setupItems()
         self.PlotItem.scene().sigMouseMoved.connect(self.__getPolyline)
-        self.PlotItem.sigRangeChanged.connect(self.__refresh_clickable_area)
         self.PlotItem.scene().sigMouseClicked.connect(self.__popPolyline)
-        # Get initial viewrange of the ViewBox, needed only for
-        # __refresh_clickable_area method
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        self.xwidth = viewrange[0][1] - viewrange[0][0]
         
     def stop(self):
         """ If called, this method disconnects all the signals """
         self.PlotItem.scene().sigMouseMoved.disconnect(self.__getPolyline)
-        self.PlotItem.sigRangeChanged.disconnect(self.__refresh_clickable_area)
         self.PlotItem.scene().sigMouseClicked.disconnect(self.__popPolyline)
 
 
@@ -692,15 +681,15 @@ class DrawPolyline:
             click_coords = self.PlotItem.vb.mapSceneToView(pos)
             self.points_list_x.append(click_coords.x())
             self.points_list_y.append(click_coords.y())
-            self.clickable_point.clear()
-            self.line_between.clear()
             self.temp_line.clear()
-            
+            # setData replaces the data of the items, they are cleared only if they are not set
             if len(self.points_list_x) >= 2:
                 self.line_between.setData(self.points_list_x, self.points_list_y)
                 self.drawn_points.setData(self.points_list_x[:-1], self.points_list_y[:-1])
                 self.clickable_point.setData([self.points_list_x[-1]], [self.points_list_y[-1]])
             elif len(self.points_list_x) == 1:
+                self.clickable_point.clear()
+                self.line_between.clear()
                 self.drawn_points.setData(self.points_list_x, self.points_list_y)
 
     def __draw_temp_line(self, event):
@@ -711,12 +700,7 @@ class DrawPolyline:
         pos = event
         mouse_coords = self.PlotItem.vb.mapSceneToView(pos)
         if len(self.points_list_x) >= 1:
-            self.temp_line.clear()
-            xx = [self.points_list_x[-1]]
-            xx.append(mouse_coords.x())
-            yy = [self.points_list_y[-1]]
-            yy.append(mouse_coords.y())
-            self.temp_line.setData(xx, yy)
+            self.temp_line.setData([self.points_list_x[-1], mouse_coords.x()], [self.points_list_y[-1], mouse_coords.y()])
 
     def __hovered(self):
         """ This method, connected with self.clickable_point.sigHovered.connect(self.__hovered),
@@ -732,8 +716,7 @@ class DrawPolyline:
         """
         self.hovered = True
         # Add polyline to initial list
-        plen = len(self.points_list_x)
-        newpolyline = np.hstack((np.array(self.points_list_x).reshape(plen, 1), np.array(self.points_list_y).reshape(plen, 1)))
+        newpolyline = np.column_stack((self.points_list_x, self.points_list_y))  # A single (n, 2) array
         self.plls.append(newpolyline)
         # Refresh plot
         self.drawn_points.clear()
@@ -755,21 +738,18 @@ class DrawPolyline:
         # Create a dict with key=int corresponding to the self.plls index
         # and value = PlotCurveItem_ith
         self.CurveItems = {} # At the end I did't use this dictionary, have to check if something can be simplified
+        lpen = pg.mkPen(color=self.lclr, width=self.lwdth)  # A single pen shared by all the polylines
         for i in range(len(self.plls)):
-            CurveItem = pg.PlotCurveItem(
-            pen=pg.mkPen(color=self.lclr, width=self.lwdth))
+            CurveItem = pg.PlotCurveItem(pen=lpen)
             #### CurveItem.setSkipFiniteCheck(True)   ## Needed recent version of pyqtgraph
             CurveItem.setData(self.plls[i][:, 0], self.plls[i][:, 1])
             self.PlotItem.addItem(CurveItem)
             self.CurveItems[i] = CurveItem
         # Here the insivible polyline is used to plot
         # all the vertices using only one ScatterPlotItem
-        polylines_linked = self.plls[0]
-        for pll in self.plls[1:]:
-            polylines_linked = np.vstack((polylines_linked, pll))
+        polylines_linked = np.vstack(self.plls)  # A single copy instead of a vstack per polyline
         # Plot points at the vertices of the polylines
-        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
-        self.ScatterItem.setData(polylines_linked[:, 0], polylines_linked[:, 1])
+        self.ScatterItem = pg.ScatterPlotItem(x=polylines_linked[:, 0], y=polylines_linked[:, 1], pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
         self.PlotItem.addItem(self.ScatterItem)
 
     def start(self):
@@ -841,57 +821,69 @@ class JoinPolylines:
         if points.shape[0] == 1:
             if self.first_poly is None:
                 # Indentify and store info of the first polyline and its clicked point
-                x_p = tuple(points[0].pos())[0]  # x coord of the clicked point
-                y_p = tuple(points[0].pos())[1]  # y coord of the clicked point
-                for i in range(len(self.plls)):
-                    if [x_p, y_p] in self.plls[i].tolist():
-                        self.first_poly = [i, self.plls[i].tolist().index([x_p, y_p])]
+                self.first_poly = self.__clickedEnd(points[0])
                         
                 # Refresh the extreme_points to avoid clicking again on the first_poly
-                self.extreme_points.clear()
-                for i in range(len(self.plls)):
-                    if i != self.first_poly[0]:                   
-                        self.extreme_points.addPoints([self.plls[i][0, 0], self.plls[i][-1, 0]], [self.plls[i][0, 1], self.plls[i][-1, 1]])
+                self.extreme_ids = [i for i in range(len(self.plls)) if i != self.first_poly[0]]
+                self.extreme_points.setData(pos=self.__extremes(self.extreme_ids))
                         
             elif self.first_poly is not None:
                 # Indentify and store info of the second polyline and its clicked point
-                x_p = tuple(points[0].pos())[0]
-                y_p = tuple(points[0].pos())[1]
-                for i in range(len(self.plls)):
-                    if [x_p, y_p] in self.plls[i].tolist():
-                        self.second_poly = [i, self.plls[i].tolist().index([x_p, y_p])]
+                self.second_poly = self.__clickedEnd(points[0])
                 
                 # Join the two polylines
+                # (reversed polylines are [::-1] views, copied only once by the concatenation)
+                first, second = self.plls[self.first_poly[0]], self.plls[self.second_poly[0]]
                 if self.first_poly[1] != 0 and self.second_poly[1] == 0:
-                    newpolyline = np.vstack((self.plls[self.first_poly[0]], self.plls[self.second_poly[0]]))
+                    newpolyline = np.concatenate((first, second), axis=0)
                 elif self.first_poly[1] != 0 and self.second_poly[1] != 0:
-                    newpolyline = np.vstack((self.plls[self.first_poly[0]], np.flip(self.plls[self.second_poly[0]], axis=0)))
+                    newpolyline = np.concatenate((first, second[::-1]), axis=0)
                 elif self.first_poly[1] == 0 and self.second_poly[1] == 0:
-                    newpolyline = np.vstack((np.flip(self.plls[self.first_poly[0]], axis=0), self.plls[self.second_poly[0]]))
-                if self.first_poly[1] == 0 and self.second_poly[1] != 0:
-                    newpolyline = np.vstack((self.plls[self.second_poly[0]], self.plls[self.first_poly[0]]))
+                    newpolyline = np.concatenate((first[::-1], second), axis=0)
+                else:
+                    newpolyline = np.concatenate((second, first), axis=0)
                 
-                # Remove the two original polylines
-                to_remove = [self.plls[self.first_poly[0]].tolist(), self.plls[self.second_poly[0]].tolist()]
-                self.plls = [pll for pll in self.plls if pll.tolist() not in to_remove]
-                # Append new joined polyline to the plls list
+                # Remove the two original polylines and their curves, the other curves are kept
+                to_remove = (self.first_poly[0], self.second_poly[0])
+                self.plls = [pll for i, pll in enumerate(self.plls) if i not in to_remove]
+                for i in to_remove:
+                    self.PlotItem.removeItem(self.CurveItems[i])
+                curves = [self.CurveItems[i] for i in range(len(self.CurveItems)) if i not in to_remove]
+                # Append new joined polyline to the plls list and plot it
                 self.plls.append(newpolyline)
+                CurveItem = pg.PlotCurveItem(pen=self.lpen)
+                CurveItem.setData(newpolyline[:, 0], newpolyline[:, 1])
+                self.PlotItem.addItem(CurveItem)
+                curves.append(CurveItem)
+                self.CurveItems = dict(enumerate(curves))  # Keys are the new indices of self.plls
                 # Set default values
                 self.first_poly = None
                 self.second_poly = None
-                # Clear plot
-                self.extreme_points.clear()
-                self.ScatterItem.clear()
-                for key in self.CurveItems:
-                    self.CurveItems[key].clear()
-                self.CurveItems = {}
-                # Refresh plot and signals
-                self.extreme_points.sigClicked.disconnect(self.__join_polylines)
-                self.__setItems()
-                self.extreme_points.sigClicked.connect(self.__join_polylines)
+                # Refresh the data of the points, their items and signals are kept
+                self.extreme_ids = list(range(len(self.plls)))
+                self.extreme_points.setData(pos=self.__extremes(self.extreme_ids))
+                polylines_linked = np.vstack([pll[1:-1] for pll in self.plls])
+                self.ScatterItem.setData(polylines_linked[:, 0], polylines_linked[:, 1])
                 if self.verbose:
                     print("Updated number of polylines: ", len(self.plls))
 
+    def __clickedEnd(self, point):
+        """ point: clicked SpotItem of self.extreme_points
+        
+        Returns [index of the polyline in self.plls, index of the clicked vertex].
+        Row r of self.extreme_points is the head (r even) or the tail (r odd)
+        of the polyline self.extreme_ids[r // 2], so no coordinates are searched
+        """
+        i = self.extreme_ids[point.index() // 2]
+        return [i, 0 if point.index() % 2 == 0 else self.plls[i].shape[0] - 1]
+
+    def __extremes(self, ids):
+        """ Returns the 2-columns np array of the first and last point
+        of the polylines self.plls[i], for i in ids
+        """
+        ends = [self.plls[i][[0, -1], : 2] for i in ids]
+        return np.vstack(ends) if ends else np.empty((0, 2))
+
     def __setItems(self):
         """ This method sets up and plots the initial given polylines
         stored in self.plls.
@@ -901,26 +893,25 @@ class JoinPolylines:
         self.extreme_points = pg.ScatterPlotItem(pxMode=True, size=1.5*self.psz, brush= pg.mkBrush(self.pclr),
                                           hoverable=True, hoverPen=pg.mkPen(self.hclr, width=self.psz/10), hoverSize=self.psz*1.3)
         self.extreme_points.setSymbol('d')       
+        self.lpen = pg.mkPen(color=self.lclr, width=self.lwdth)  # A single pen shared by all the polylines
         for i in range(len(self.plls)):
             # Create and plot polylines, first and last point items
-            CurveItem = pg.PlotCurveItem(
-            pen=pg.mkPen(color=self.lclr, width=self.lwdth))
+            CurveItem = pg.PlotCurveItem(pen=self.lpen)
             #### CurveItem.setSkipFiniteCheck(True)   ## Needed recent version of pyqtgraph
             CurveItem.setData(self.plls[i][:, 0], self.plls[i][:, 1])
             self.PlotItem.addItem(CurveItem)
-            self.extreme_points.addPoints([self.plls[i][0, 0], self.plls[i][-1, 0]], [self.plls[i][0, 1], self.plls[i][-1, 1]])
             # Store plot items in the dictionary
             self.CurveItems[i] = CurveItem
-            
+        # First and last points of all the polylines, set with a single call.
+        # self.extreme_ids[r // 2] is the polyline of the row r of extreme_points
+        self.extreme_ids = list(range(len(self.plls)))
+        self.extreme_points.setData(pos=self.__extremes(self.extreme_ids))
         self.PlotItem.addItem(self.extreme_points)
         # Here the insivible polyline is used to plot
         # the vertices (except first and last) using only one ScatterPlotItem
-        polylines_linked = self.plls[0][1:-1]
-        for pll in self.plls[1:]:
-            polylines_linked = np.vstack((polylines_linked, pll[1:-1]))
+        polylines_linked = np.vstack([pll[1:-1] for pll in self.plls])  # A single copy
         # Plot points at the vertices of the polylines (except first and last)
-        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
-        self.ScatterItem.setData(polylines_linked[:, 0], polylines_linked[:, 1])
+        self.ScatterItem = pg.ScatterPlotItem(x=polylines_linked[:, 0], y=polylines_linked[:, 1], pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
         self.PlotItem.addItem(self.ScatterItem)
 
     def start(self):
@@ -963,6 +954,28 @@ class OffsetPolyline:
         self.hclr = hclr            # Color or the hover
         self.hlclr = hlclr          # Color of the line when the mouse is on it (hover)
         self.verbose = verbose      # If True, plots the changing pll after the action is completed
+        # Pens of the polylines, created once and reused at every mouse move
+        self.lpen = pg.mkPen(color=self.lclr, width=self.lwdth)
+        self.hlpen = pg.mkPen(color=self.hlclr, width=self.lwdth*1.3)
+        self.offsetcache = {}       # key=(index of self.plls, offset), value=coordinates of the offset polyline
+        self.tomodify = None        # Key of self.CurveItems of the polyline under the mouse pointer
+        self.hovered = None         # (self.tomodify, self.offset) of the current highlight and preview
+    
+    def __offsetCoords(self, i):
+        """ Returns the list of the np arrays of the coordinates of the offset of self.plls[i],
+        one per part: near tight bends the offset can split into a MultiLineString.
+        Parts with less than two points are dropped, so the list can be empty.
+        It is computed once per polyline and offset, not at every mouse move
+        (self.plls is only appended to, so the indices do not change)
+        """
+        key = (i, self.offset)
+        if self.plls[i].shape[0] < 2:
+            return []  # A single vertex has no offset
+        if key not in self.offsetcache:
+            offpoly = LineString(self.plls[i]).parallel_offset(np.absolute(self.offset), side=self.side, resolution=5, join_style=2, mitre_limit=5)
+            parts = [shapely.get_coordinates(part) for part in shapely.get_parts(offpoly)]
+            self.offsetcache[key] = [part for part in parts if len(part) >= 2]
+        return self.offsetcache[key]
     
     def __getPolyline(self, event):
         """ This method changes the color of the pollyline under the mouse pointer and 
@@ -972,30 +985,35 @@ class OffsetPolyline:
         self.setSide()
         pos = event  # The position for sigMouseMoved is already in Scene Coordinates
         mpos = self.PlotItem.vb.mapSceneToView(pos)  # Mouse position
-        # Highlight the element under the mouse pointer and save its key in self.tomodify
-        if self.invisible_polyline.mouseShape().contains(mpos):
-            found = False  # Counter to avoid selecting two segments together
-            discarded = 0
-            for key in self.CurveItems:
-                if self.CurveItems[key].mouseShape().contains(mpos) and found == False:
-                    self.CurveItems[key].setPen(pg.mkPen(color=self.hlclr, width=self.lwdth*1.3))
-                    self.tomodify = key  # Dict's key of the selected segment where to add a point (after a click)
-                    # Draw temporary offset polyline
-                    try:
-                        tempOff = np.array(LineString(self.plls[self.tomodify]).parallel_offset(np.absolute(self.offset), side=self.side, resolution=5, join_style=2, mitre_limit=5))
-                        self.tempOff.setData(tempOff[:, 0], tempOff[:, 1])
-                    except IndexError:
-                        continue  # Probably this error happens because of weird data collected by mistake by the mouse
-                    found = True
-                else:
-                    self.CurveItems[key].setPen(pg.mkPen(color=self.lclr, width=self.lwdth))
-                    discarded += 1
-                if discarded == len(self.CurveItems):
-                    self.tomodify = None
-            found = False
-        else:
-            self.tomodify = None
+        tomodify = None  # Key of the polyline under the mouse pointer
+        # Only the polylines whose bounding box intersects a square around the mouse, whose half side
+        # is half the clickable width (7 px) plus a margin, are tested segment by segment.
+        # They are found through the STRtree of the polylines, without scanning all of them
+        px, py = self.PlotItem.vb.viewPixelSize()
+        x, y = mpos.x(), mpos.y()
+        for key in np.sort(self.treekeys[self.tree.query(shapely.box(x - 4 * px, y - 4 * py, x + 4 * px, y + 4 * py))]):
+            pll = self.plls[key]
+            if _first_segment_near(pll[: -1], pll[1:], x, y, px, py) is not None:
+                tomodify = int(key)  # The first polyline found, to avoid selecting two polylines together
+                break
+        # Highlight the polyline under the mouse pointer, draw its temporary offset polyline and
+        # save its key in self.tomodify. Pens and preview are changed only when the polyline
+        # under the mouse (or the offset) changes, not at every mouse move
+        if (tomodify, self.offset) != self.hovered:
+            if self.tomodify is not None:
+                self.CurveItems[self.tomodify].setPen(self.lpen)
             self.tempOff.clear()
+            if tomodify is not None:
+                self.CurveItems[tomodify].setPen(self.hlpen)
+                parts = self.__offsetCoords(tomodify)
+                if parts:
+                    # The parts are drawn by a single item, not connected to each other
+                    tempOff = np.concatenate(parts, axis=0)
+                    connect = np.ones(len(tempOff), dtype=bool)
+                    connect[np.cumsum([len(part) for part in parts]) - 1] = False
+                    self.tempOff.setData(tempOff[:, 0], tempOff[:, 1], connect=connect)
+            self.tomodify = tomodify  # Dict's key of the polyline to offset (after a click)
+            self.hovered = (tomodify, self.offset)
 
             
     
@@ -1006,63 +1024,31 @@ class OffsetPolyline:
         self.setSide
         
         if self.tomodify is not None:  # self.tomodify is set in __Polyline method
-            # Disconnect signal for refresh function to avoid plot problems
-            self.PlotItem.sigRangeChanged.disconnect(self.__refresh_clickable_area)
             # Create new offset polyline and add it to the initial list of polylines
+            # Each part of the offset is a new polyline. Offset of a closed polyline could have no parts
+            newpolys = self.__offsetCoords(self.tomodify)
+            for newpoly in newpolys:
+                self.plls.append(newpoly)  # Shapely >= 2 keeps the direction of the polyline on both sides
+                # Only the new polyline is added to the plot, the existing items are kept
+                CurveItem = pg.PlotCurveItem(pen=self.lpen)
+                CurveItem.setData(newpoly[:, 0], newpoly[:, 1])
+                self.PlotItem.addItem(CurveItem)
+                self.CurveItems[len(self.plls) - 1] = CurveItem
+                self.ScatterItem.addPoints(newpoly[:, 0], newpoly[:, 1])
+            if newpolys:
+                self.__setTree()
             
-            
-            newpoly = np.array(LineString(self.plls[self.tomodify]).parallel_offset(np.absolute(self.offset), side=self.side, resolution=5, join_style=2, mitre_limit=5))
-            if len(newpoly) >= 2:  # Offset of a closed polyline could result in a empty array
-                if self.side == 'left':
-                    self.plls.append(newpoly)
-                elif self.side == 'right':  # Shapely flips the array if side == right
-                    self.plls.append(np.flip(newpoly, axis=0))
-            
-            # Update the polyline attribute self.pll with the new reassembled one
             if self.verbose:
                 print("\nNew number of polylines: ", len(self.plls))
-            # Clean up the plot and CurveItems dictionary
-            for key in self.CurveItems:
-                self.PlotItem.removeItem(self.CurveItems[key])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.CurveItems = {}
-            # Setup again plot and data
-            self.__setupItems()
-            # Reconnect signal
-            self.PlotItem.sigRangeChanged.connect(self.__refresh_clickable_area)
             
     
-    def __refresh_clickable_area(self):
-        """ This method solves the problem that happen when after a point has
-        been added with a lot of zoom, it is not possible to click on the segment
-        if the user zooms out.
-        
-        !! For this RemovePolyline class this method could be disconnected
-        to improve performances, or maybe just set a higher threshold !!
-        (comment copied from RemovePolyline, should be ok)
+    def __setTree(self):
+        """ This method builds the STRtree of the plotted polylines, used by __getPolyline.
+        Item i of the tree is the polyline self.plls[self.treekeys[i]]. The polylines with a
+        single vertex (e.g. left by the P tool) cannot be offset, so they are not in the tree
         """
-        # Get ViewBox's viewrange info
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        new_xwidth = viewrange[0][1] - viewrange[0][0]
-        # Update everything only if the user has zoomed more than a threshold
-        if np.absolute((self.xwidth - new_xwidth) / self.xwidth) > 0.7:
-            # Disconnect signals to avoid problems (Maybe useless)
-            self.PlotItem.scene().sigMouseMoved.disconnect(self.__getPolyline)
-            self.PlotItem.scene().sigMouseClicked.disconnect(self.__offPolyline)
-            # Update self.xwidth
-            self.xwidth = new_xwidth
-            # Clean up plot and populate it again (through __setupItems)
-            for key in self.CurveItems:
-                self.PlotItem.removeItem(self.CurveItems[key])
-            self.PlotItem.removeItem(self.invisible_polyline)
-            self.PlotItem.removeItem(self.ScatterItem)
-            self.CurveItems = {}
-            self.__setupItems()
-            # Reconnect signals
-            self.PlotItem.scene().sigMouseMoved.connect(self.__getPolyline)
-            self.PlotItem.scene().sigMouseClicked.connect(self.__offPolyline)
+        self.treekeys = np.array([key for key in self.CurveItems if self.plls[key].shape[0] >= 2], dtype=int)
+        self.tree = shapely.STRtree([LineString(self.plls[key][:, : 2]) for key in self.treekeys])
 
     def __setupItems(self):
         """ This method creates a dict of curveitems from the polylines and
@@ -1072,9 +1058,7 @@ class OffsetPolyline:
         # and value = PlotCurveItem_ith
         self.CurveItems = {}
         for i in range(len(self.plls)):
-            CurveItem = pg.PlotCurveItem(
-            pen=pg.mkPen(color=self.lclr, width=self.lwdth))
-            CurveItem.setClickable(False, width=7)
+            CurveItem = pg.PlotCurveItem(pen=self.lpen)
             #### CurveItem.setSkipFiniteCheck(True)   ## Needed recent version of pyqtgraph
             try:
                 CurveItem.setData(self.plls[i][:, 0], self.plls[i][:, 1])
@@ -1082,23 +1066,12 @@ class OffsetPolyline:
                 self.CurveItems[i] = CurveItem
             except IndexError:
                 continue  # This happens when messing up with offset
+        self.__setTree()
             
-        # This invisible_polyline avoids to keep looping
-        # on all the polylines when the mouse pointer is far from them
-        polylines_linked = self.plls[0]
-        for pll in self.plls[1:]:
-            try:
-                polylines_linked = np.vstack((polylines_linked, pll))
-            except ValueError:
-                continue  # This happens when trying to offset a "closed" concave polyline
-        self.invisible_polyline = pg.PlotCurveItem(
-            pen=pg.mkPen((255, 255, 0, 0), width=1))
-        self.invisible_polyline.setClickable(False, width=100)
-        self.invisible_polyline.setData(polylines_linked[:, 0], polylines_linked[:, 1])
-        self.PlotItem.addItem(self.invisible_polyline)
+        # A single copy instead of a vstack per polyline
+        polylines_linked = np.concatenate(self.plls, axis=0)
         # Plot points at the vertices of the polylines
-        self.ScatterItem = pg.ScatterPlotItem(pxMode=True, size=self.psz, brush= pg.mkBrush(self.pclr))
-        self.ScatterItem.addPoints(polylines_linked[:, 0], polylines_linked[:, 1])
+        self.ScatterItem = pg.ScatterPlotItem(x=polylines_linked[:, 0], y=polylines_linked[:, 1], pxMode=True, size=self.psz, brush=pg.mkBrush(self.pclr))
         # self.ScatterItem.setSymbol('crosshair')
         self.PlotItem.addItem(self.ScatterItem)
         
@@ -1123,22 +1096,16 @@ class OffsetPolyline:
         if self.verbose:
             print("\nInitial number of polylines: ", len(self.plls))
             print(self.plls)
-        # Initialize plots and data and connect signals
+        # Initialize plots and data and connect signals. The polylines are hit-tested in pixels
+        # at the current zoom, so nothing has to be refreshed when the view range changes
         self.__setupItems()
         self.PlotItem.scene().sigMouseMoved.connect(self.__getPolyline)
-        self.PlotItem.sigRangeChanged.connect(self.__refresh_clickable_area)
         self.PlotItem.scene().sigMouseClicked.connect(self.__offPolyline)
-        # Get initial viewrange of the ViewBox, needed only for
-        # __refresh_clickable_area method
-        vbstate = self.PlotItem.vb.getState(copy=True)
-        viewrange = vbstate['viewRange']
-        self.xwidth = viewrange[0][1] - viewrange[0][0]
 
         
     def stop(self):
         """ If called, this method disconnects all the signals """
         self.PlotItem.scene().sigMouseMoved.disconnect(self.__getPolyline)
-        self.PlotItem.sigRangeChanged.disconnect(self.__refresh_clickable_area)
         self.PlotItem.scene().sigMouseClicked.disconnect(self.__offPolyline)
 
 